@@ -1,10 +1,10 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, flash, url_for
-from taskgenie import TaskGenieApp
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, flash, url_for, stream_with_context
+from taskgenie import TaskGenieApp, normalize_user_key
+from calendar_sync import CalendarSync
 from dotenv import load_dotenv
 from bson import ObjectId
 import asyncio
-import re
-from datetime import datetime, timedelta
+from datetime import datetime
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
@@ -40,6 +40,10 @@ app.secret_key = os.getenv('FLASK_SECRET_KEY', 'dev_key_123')  # fallback to dev
 load_dotenv()
 task_genie = TaskGenieApp()
 
+# Fields the calendar view renders; everything else stays in MongoDB
+CALENDAR_EVENT_FIELDS = ['Title', 'Start Time', 'End Time', 'google_event_id']
+CALENDAR_TASK_FIELDS = ['Title', 'Start Time', 'End Time', 'Due Date', 'google_event_id']
+
 # Store user sessions
 user_sessions = {}
 
@@ -177,35 +181,10 @@ def oauth2callback():
             
             # Initial calendar sync for Google users
             if session['user_name'] != 'guest':
-                task_genie.db.connect()
-                
-                # Remove all existing events and tasks for this user
-                task_genie.db.db['events'].delete_many({'User': session['user_name']})
-                task_genie.db.db['tasks'].delete_many({'User': session['user_name']})
-                
-                # Get events from Google Calendar
+                # Import only what changed in Google Calendar since the last login
                 calendar_service = build('calendar', 'v3', credentials=credentials)
-                now = datetime.utcnow()
-                thirty_days_ago = now - timedelta(days=30)
-                events_result = calendar_service.events().list(
-                    calendarId='primary',
-                    timeMin=thirty_days_ago.isoformat() + 'Z',
-                    # timeMax=(now + timedelta(days=30)).isoformat() + 'Z',
-                    maxResults=999,
-                    singleEvents=True,
-                    orderBy='startTime'
-                ).execute()
-                google_events = events_result.get('items', [])
-                
-                # Import all Google Calendar events to MongoDB
-                for google_event in google_events:
-                    try:
-                        process_google_calendar_event(google_event, session['user_name'], task_genie.db)
-                    except KeyError as e:
-                        logger.warning(f"Skipping event due to missing field: {str(e)}")
-                        continue
-                
-                task_genie.db.close()
+                CalendarSync(calendar_service, task_genie.db).pull(session['user_name'])
+                task_genie.embedding_pipeline.submit_dirty('events', normalize_user_key(session['user_name']))
             
             return redirect('/')
             
@@ -235,242 +214,220 @@ def chat():
             return jsonify({'error': 'Missing message'}), 400
             
         # Process message and get response
-        task_genie.db.connect()
-        action = task_genie.categorizer.categorize_input(message)
-        
-        response = {
-            'action': action,
-            'message': '',
-            'data': None
-        }
+        action, extraction = task_genie.categorize(user_name, message)
         
-        # Handle different action types
-        if action == 'Query':
-            raw_results, filtered_results = run_async(
-                task_genie.query_processor.process_query(user_name, message, precise=False)
-            )
-            response['message'] = filtered_results
-            response['data'] = raw_results
-            # print(f"Raw results: {raw_results}")
-            
-            
-        elif action == 'Schedule':
-            event_task = task_genie.categorizer.categorize_event_task(message)
-            if event_task == "Event":
-                event_json = task_genie.query_processor.extract_event_information(
-                    message, user_name
-                )
-                response['message'] = "Would you like to schedule this event?"
-                response['data'] = event_json
-            elif event_task == "Task":
-                task_json = task_genie.query_processor.extract_task_information(
-                    message, user_name
-                )
-                response['message'] = "Would you like to schedule this task?"
-                response['data'] = task_json
-                
-        elif action == 'Update':
-            # First, find the document to update
-            search_prompt = """
-            Convert the following update request into a search/query request.
-            Keep all the important search criteria (who, what, when, where) but change the action verb to find/show/what/list.
-            Relax all the time information from the query.
-
-            Examples:
-            - Input: "update my meeting with Bob tomorrow" -> "find my meeting with Bob tomorrow (any time tomorrow)"
-            - Input: "change my dentist appointment" -> "when is my dentist appointment (any time)"
-            - Input: "modify the team meeting at 3pm" -> "find the team meeting (any time)"
-
-            Update request: "{query}"
-
-            Return only the converted query, nothing else.
-            """
-            search_query = task_genie.openai_service.create_chat_completion(
-                search_prompt.format(query=message),
-                "You are an AI assistant specializing in converting update requests into search queries."
-            ).strip()
-            
-            raw_results, _ = run_async(task_genie.query_processor.process_query(user_name, search_query, precise=True))
-            # print(f"Raw results: {raw_results}")
-            if raw_results and len(raw_results) > 0:
-                original_doc = raw_results[0]
-                # Determine if it's an event or task
-                is_task = 'Due Date' in original_doc
-                
-                if is_task:
-                    query = f"Update the following task as follows: ```{message}```\n\nOriginal task: ```{json.dumps(original_doc, indent=2)} ```"
-                    updated_doc = task_genie.query_processor.extract_task_information(query, user_name)
-                else:
-                    query = f"Update the following event as follows: ```{message}```\n\nOriginal event: ```{json.dumps(original_doc, indent=2)} ```"
-                    updated_doc = task_genie.query_processor.extract_event_information(query, user_name)
-                print(query)
-                
-                if updated_doc:
-                    # Preserve the original ID and google_event_id
-                    updated_doc['_id'] = original_doc['_id']
-                    if 'google_event_id' in original_doc:
-                        updated_doc['google_event_id'] = original_doc['google_event_id']
-                    
-                    # Create display data with both original and updated info
-                    display_data = {
-                        'original': original_doc,
-                        'update': updated_doc
-                    }
-                    
-                    response['message'] = "Please confirm the update:"
-                    response['data'] = display_data
-                else:
-                    response['message'] = "Failed to process update information."
-            else:
-                response['message'] = "No matching events or tasks found."
-                
-        elif action == 'Delete':
-            search_prompt = """
-            Convert the following delete request into a search/query request. 
-            Keep all the important search criteria (who, what, when, where) but change the action verb to find/show/what/list.
-            Relax all the time information from the query.
-
-            Examples:
-            - Input: "delete my meeting with Bob tomorrow" -> "find my meeting with Bob tomorrow (any time tomorrow)"
-            - Input: "cancel my dentist appointment" -> "what is my dentist appointment (any time)"
-            - Input: "clear my schedule for next week" -> "what is my schedule (any time next week)"
-            - Input: "drop the team meeting at 3pm" -> "find the team meeting (any time)"
-            - Input: "cancel my tasks tomorrow" -> "what are my tasks (any time tomorrow)"
-
-            Delete request: "{query}"
-
-            Return only the converted query, nothing else.
-            """
-            search_query = task_genie.openai_service.create_chat_completion(
-                search_prompt.format(query=message),
-                "You are an AI assistant specializing in converting delete requests into search queries."
-            ).strip()
-
-            print(f"Search query: {search_query}")
-            
-            raw_results, _ = run_async(task_genie.query_processor.process_query(user_name, search_query, precise=True))
-            print(f"Raw results: {raw_results}")
-            if raw_results:
-                response['message'] = "Found this matching document to delete:"
-                response['data'] = raw_results[0]
-            else:
-                response['message'] = "No matching events or tasks found."
-                
-        elif action == 'Conversation':
-            system_content = f"You are TaskGenie, a concise AI assistant. The user is {user_name}."
-            response_content, conversation_history = task_genie.openai_service.create_chat_conversation(
-                message,
-                system_content,
-                user_sessions.get(user_name, {}).get('conversation_history', [])
-            )
-            if user_name not in user_sessions:
-                user_sessions[user_name] = {}
-            user_sessions[user_name]['conversation_history'] = conversation_history
-            print(f"Conversation history: {conversation_history}")
-            response['message'] = response_content
-            
-        return jsonify(response)
+        return jsonify(respond_to_message(user_name, message, action, extraction))
         
     except Exception as e:
         logger.error(f"Error in chat: {str(e)}")
         return jsonify({'error': str(e)}), 500
-    finally:
-        task_genie.db.close()
 
-def sync_with_google_calendar(user_email, event):
-    """Sync single event with Google Calendar"""
-    if 'credentials' not in session:
-        logger.warning("No credentials found in session")
-        return False
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Handle chat messages, streaming query answers as server-sent events"""
+    try:
+        # Verify user is authenticated
+        user_name = session.get('user_name')
+        if not user_name:
+            return jsonify({'error': 'User not authenticated'}), 401
+            
+        # Get message from request
+        data = request.json
+        message = data.get('message')
+        if not message:
+            return jsonify({'error': 'Missing message'}), 400
+            
+        action, extraction = task_genie.categorize(user_name, message)
         
-    credentials = Credentials(**session['credentials'])
-    
-    if not credentials.valid:
-        if credentials.expired and credentials.refresh_token:
+        # Only query answers are generated text worth streaming; everything else is answered as /chat does
+        if action != 'Query':
+            return jsonify(respond_to_message(user_name, message, action, extraction))
+            
+        raw_results = run_async(task_genie.query_processor.retrieve(user_name, message, precise=False))
+        
+        def generate():
+            yield server_sent_event('meta', {'action': action, 'data': raw_results})
             try:
-                credentials.refresh(Request())
-                session['credentials']['token'] = credentials.token
+                for chunk in task_genie.query_processor.intelligent_filter_stream(message, raw_results, user_name):
+                    yield server_sent_event('token', {'text': chunk})
+                yield server_sent_event('done', {})
             except Exception as e:
-                logger.error(f"Failed to refresh credentials: {str(e)}")
-                return False
-        else:
-            logger.warning("Invalid credentials and cannot refresh")
-            return False
-            
-    service = build('calendar', 'v3', credentials=credentials)
+                logger.error(f"Error while streaming chat answer: {str(e)}")
+                yield server_sent_event('error', {'error': str(e)})
+                
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        
+    except Exception as e:
+        logger.error(f"Error in chat stream: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def server_sent_event(event, payload):
+    """Format one server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(payload, cls=MongoJSONEncoder)}\n\n"
+
+def respond_to_message(user_name, message, action, extraction=None):
+    """Build the chat response for a categorized message, reusing a combined extraction if one was made"""
+    response = {
+        'action': action,
+        'message': '',
+        'data': None
+    }
     
-    try:
-        # Ensure datetime is in RFC3339 format
-        start_time = datetime.fromisoformat(event['Start Time'].replace('Z', '+00:00'))
-        end_time = datetime.fromisoformat(event['End Time'].replace('Z', '+00:00'))
+    # Handle different action types
+    if action == 'Query':
+        raw_results, filtered_results = run_async(
+            task_genie.query_processor.process_query(user_name, message, precise=False)
+        )
+        response['message'] = filtered_results
+        response['data'] = raw_results
+        # print(f"Raw results: {raw_results}")
         
-        calendar_event = {
-            'summary': event['Title'],
-            'description': event.get('Description', ''),
-            'start': {
-                'dateTime': start_time.isoformat(),
-                'timeZone': 'America/New_York',
-            },
-            'end': {
-                'dateTime': end_time.isoformat(),
-                'timeZone': 'America/New_York',
-            },
-            'location': event.get('Location', ''),
-            'reminders': {
-                'useDefault': True
-            }
-        }
         
-        try:
-            # If event has a Google Calendar ID, update it
-            if 'google_event_id' in event:
-                try:
-                    # Try to get the event first to make sure it exists
-                    service.events().get(
-                        calendarId='primary',
-                        eventId=event['google_event_id']
-                    ).execute()
-                    
-                    # If event exists, update it
-                    result = service.events().update(
-                        calendarId='primary',
-                        eventId=event['google_event_id'],
-                        body=calendar_event
-                    ).execute()
-                except Exception as e:
-                    # If event doesn't exist in Google Calendar, create new one
-                    logger.warning(f"Event not found in Google Calendar, creating new: {str(e)}")
-                    result = service.events().insert(
-                        calendarId='primary', 
-                        body=calendar_event
-                    ).execute()
+    elif action == 'Schedule':
+        extraction = extraction or {}
+        event_task = extraction.get('event_task') or task_genie.categorizer.categorize_event_task(message)
+        if event_task == "Event":
+            event_json = extraction.get('document') or task_genie.query_processor.extract_event_information(
+                message, user_name
+            )
+            response['message'] = "Would you like to schedule this event?"
+            response['data'] = event_json
+        elif event_task == "Task":
+            task_json = extraction.get('document') or task_genie.query_processor.extract_task_information(
+                message, user_name
+            )
+            response['message'] = "Would you like to schedule this task?"
+            response['data'] = task_json
+            
+    elif action == 'Update':
+        # First, find the document to update
+        search_prompt = """
+        Convert the following update request into a search/query request.
+        Keep all the important search criteria (who, what, when, where) but change the action verb to find/show/what/list.
+        Relax all the time information from the query.
+
+        Examples:
+        - Input: "update my meeting with Bob tomorrow" -> "find my meeting with Bob tomorrow (any time tomorrow)"
+        - Input: "change my dentist appointment" -> "when is my dentist appointment (any time)"
+        - Input: "modify the team meeting at 3pm" -> "find the team meeting (any time)"
+
+        Update request: "{query}"
+
+        Return only the converted query, nothing else.
+        """
+        search_query = task_genie.openai_service.create_chat_completion(
+            search_prompt.format(query=message),
+            "You are an AI assistant specializing in converting update requests into search queries."
+        ).strip()
+        
+        raw_results, _ = run_async(task_genie.query_processor.process_query(user_name, search_query, precise=True))
+        # print(f"Raw results: {raw_results}")
+        if raw_results and len(raw_results) > 0:
+            original_doc = raw_results[0]
+            # Determine if it's an event or task
+            is_task = 'Due Date' in original_doc
+            
+            if is_task:
+                query = f"Update the following task as follows: ```{message}```\n\nOriginal task: ```{json.dumps(original_doc, indent=2)} ```"
+                updated_doc = task_genie.query_processor.extract_task_information(query, user_name)
             else:
-                # Create new event
-                result = service.events().insert(
-                    calendarId='primary', 
-                    body=calendar_event
-                ).execute()
+                query = f"Update the following event as follows: ```{message}```\n\nOriginal event: ```{json.dumps(original_doc, indent=2)} ```"
+                updated_doc = task_genie.query_processor.extract_event_information(query, user_name)
+            print(query)
+            
+            if updated_doc:
+                # Preserve the original ID and google_event_id
+                updated_doc['_id'] = original_doc['_id']
+                if 'google_event_id' in original_doc:
+                    updated_doc['google_event_id'] = original_doc['google_event_id']
                 
-            # Store the Google Calendar event ID
-            event['google_event_id'] = result['id']
-            
-            # Update the event in MongoDB with the new google_event_id
-            if '_id' in event:
-                task_genie.db.db['events'].update_one(
-                    {'_id': ObjectId(event['_id'])},
-                    {'$set': {'google_event_id': result['id']}}
-                )
+                # Create display data with both original and updated info
+                display_data = {
+                    'original': original_doc,
+                    'update': updated_doc
+                }
                 
-            logger.info(f"Successfully synced event {event['Title']} with Google Calendar")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Error syncing with Google Calendar: {str(e)}")
-            return False
-            
+                response['message'] = "Please confirm the update:"
+                response['data'] = display_data
+            else:
+                response['message'] = "Failed to process update information."
+        else:
+            response['message'] = "No matching events or tasks found."
+            
+    elif action == 'Delete':
+        search_prompt = """
+        Convert the following delete request into a search/query request. 
+        Keep all the important search criteria (who, what, when, where) but change the action verb to find/show/what/list.
+        Relax all the time information from the query.
+
+        Examples:
+        - Input: "delete my meeting with Bob tomorrow" -> "find my meeting with Bob tomorrow (any time tomorrow)"
+        - Input: "cancel my dentist appointment" -> "what is my dentist appointment (any time)"
+        - Input: "clear my schedule for next week" -> "what is my schedule (any time next week)"
+        - Input: "drop the team meeting at 3pm" -> "find the team meeting (any time)"
+        - Input: "cancel my tasks tomorrow" -> "what are my tasks (any time tomorrow)"
+
+        Delete request: "{query}"
+
+        Return only the converted query, nothing else.
+        """
+        search_query = task_genie.openai_service.create_chat_completion(
+            search_prompt.format(query=message),
+            "You are an AI assistant specializing in converting delete requests into search queries."
+        ).strip()
+
+        print(f"Search query: {search_query}")
+        
+        raw_results, _ = run_async(task_genie.query_processor.process_query(user_name, search_query, precise=True))
+        print(f"Raw results: {raw_results}")
+        if raw_results:
+            response['message'] = "Found this matching document to delete:"
+            response['data'] = raw_results[0]
+        else:
+            response['message'] = "No matching events or tasks found."
+            
+    elif action == 'Conversation':
+        system_content = f"You are TaskGenie, a concise AI assistant. The user is {user_name}."
+        response_content, conversation_history = task_genie.openai_service.create_chat_conversation(
+            message,
+            system_content,
+            user_sessions.get(user_name, {}).get('conversation_history', [])
+        )
+        if user_name not in user_sessions:
+            user_sessions[user_name] = {}
+        user_sessions[user_name]['conversation_history'] = conversation_history
+        print(f"Conversation history: {conversation_history}")
+        response['message'] = response_content
+        
+    return response
+
+def client_document(document):
+    """Drop the internal bookkeeping fields before a document is sent to the browser"""
+    return {key: value for key, value in document.items()
+            if key not in task_genie.query_processor.RESULT_PROJECTION}
+
+def get_calendar_service():
+    """Build a Google Calendar service from the session credentials, refreshing them if needed"""
+    credentials = refresh_google_credentials()
+    if credentials is None:
+        logger.warning("No valid Google credentials found in session")
+        return None
+    return build('calendar', 'v3', credentials=credentials, cache_discovery=False)
+
+def sync_with_google_calendar(collection, documents, deleted=()):
+    """Push changed events or tasks to Google Calendar in batches, skipping unchanged ones"""
+    service = get_calendar_service()
+    if service is None:
+        return None
+    try:
+        return CalendarSync(service, task_genie.db).sync(collection, documents, deleted)
     except Exception as e:
-        logger.error(f"Error preparing event data: {str(e)}")
-        return False
+        logger.error(f"Error syncing with Google Calendar: {str(e)}")
+        return None
 
 @app.route('/confirm', methods=['POST'])
 def confirm_action():
@@ -481,7 +438,6 @@ def confirm_action():
         document = data.get('document')
         
         user_name = session.get('user_name')
-        user_email = session.get('user_email')
         
         if not user_name:
             return jsonify({'error': 'User not authenticated'}), 401
@@ -489,34 +445,30 @@ def confirm_action():
         if not all([action, confirmed is not None, document]):
             return jsonify({'error': 'Missing required fields'}), 400
             
-        task_genie.db.connect()
-        
         if not confirmed:
             return jsonify({'message': 'Action cancelled'})
 
-        # Helper function to reschedule and sync tasks
-        def reschedule_and_sync_tasks():
+        # Cached answers for this user may describe data this write is about to change
+        task_genie.query_processor.response_cache.invalidate_user(normalize_user_key(user_name))
+
+        # Helper function to reschedule and sync the tasks affected by this change
+        def reschedule_and_sync_tasks(changed_document=None, previous_document=None):
             if user_name == 'guest':
                 return
                 
             try:
-                # Reschedule all tasks
+                # Score any new tasks, then re-place only the tasks this change can move
                 task_genie.task_scheduler.calculate_task_metrics(user_name)
-                task_genie.task_scheduler.calculate_task_urgency(user_name)
-                task_genie.task_scheduler.schedule_tasks(user_name)
+                moved_tasks = task_genie.task_scheduler.reschedule_incremental(
+                    user_name, changed_document, previous_document)
                 logger.info("Successfully scheduled tasks")
                 
-                # Sync all tasks with Google Calendar
-                all_tasks = task_genie.db.db['tasks'].find({'User': user_name})
-                for task in all_tasks:
-                    sync_success = sync_with_google_calendar(user_email, task)
-                    if sync_success:
-                        task_genie.db.db['tasks'].update_one(
-                            {'_id': task['_id']},
-                            {'$set': {'google_event_id': task['google_event_id']}}
-                        )
-                    else:
-                        logger.warning(f"Failed to sync task {task['_id']} with Google Calendar")
+                # Sync only the tasks whose slot changed with Google Calendar
+                sync_with_google_calendar(
+                    'tasks',
+                    [task for task in moved_tasks if task.get('Start Time')],
+                    deleted=[task for task in moved_tasks if not task.get('Start Time')]
+                )
             except Exception as e:
                 logger.error(f"Error in reschedule_and_sync_tasks: {str(e)}")
             
@@ -531,20 +483,15 @@ def confirm_action():
             document['_id'] = str(doc_id)
             
             # Reschedule and sync tasks
-            reschedule_and_sync_tasks()
+            reschedule_and_sync_tasks(document)
             
             # If it's an event, sync it with Google Calendar
             if collection == 'events' and user_name != 'guest':
-                sync_success = sync_with_google_calendar(user_email, document)
-                if sync_success:
-                    task_genie.db.db[collection].update_one(
-                        {'_id': ObjectId(doc_id)},
-                        {'$set': {'google_event_id': document['google_event_id']}}
-                    )
+                sync_with_google_calendar(collection, [document])
             
             return jsonify({
                 'message': f'Successfully scheduled the {collection[:-1]}',
-                'document': document
+                'document': client_document(document)
             })
             
         elif action == 'Update':
@@ -556,37 +503,29 @@ def confirm_action():
                 return jsonify({'error': 'Document ID missing'}), 400
                 
             # Preserve google_event_id if it exists
-            original_doc = task_genie.db.db[collection].find_one({'_id': ObjectId(doc_id)})
+            original_doc = task_genie.db.db[collection].find_one({'_id': ObjectId(doc_id)}, task_genie.db.DEFAULT_PROJECTION)
             if original_doc and 'google_event_id' in original_doc:
                 update_doc['google_event_id'] = original_doc['google_event_id']
             
-            result = task_genie.db.db[collection].update_one(
-                {'_id': ObjectId(doc_id)},
-                {'$set': update_doc}
-            )
+            result = task_genie.db.update_document(collection, doc_id, update_doc)
             
             if result.modified_count != 1:
                 return jsonify({'error': 'Failed to update the document'}), 400
                 
             # Get the updated document
-            updated_doc = task_genie.db.db[collection].find_one({'_id': ObjectId(doc_id)})
+            updated_doc = task_genie.db.db[collection].find_one({'_id': ObjectId(doc_id)}, task_genie.db.DEFAULT_PROJECTION)
             updated_doc['_id'] = str(updated_doc['_id'])
             
             # Reschedule and sync tasks
-            reschedule_and_sync_tasks()
+            reschedule_and_sync_tasks(updated_doc, original_doc)
             
             # If it's an event, sync it with Google Calendar
             if collection == 'events' and user_name != 'guest':
-                sync_success = sync_with_google_calendar(user_email, updated_doc)
-                if sync_success:
-                    task_genie.db.db[collection].update_one(
-                        {'_id': ObjectId(doc_id)},
-                        {'$set': {'google_event_id': updated_doc['google_event_id']}}
-                    )
+                sync_with_google_calendar(collection, [updated_doc])
             
             return jsonify({
                 'message': 'Successfully updated the document',
-                'document': updated_doc
+                'document': client_document(updated_doc)
             })
             
         elif action == 'Delete':
@@ -596,30 +535,19 @@ def confirm_action():
             if not document_id:
                 return jsonify({'error': 'Document ID missing'}), 400
                 
+            event = task_genie.db.db[collection].find_one({'_id': ObjectId(document_id)}, task_genie.db.DEFAULT_PROJECTION)
+            
             # Delete from Google Calendar first if applicable
             if user_name != 'guest':
-                try:
-                    credentials = Credentials(**session['credentials'])
-                    service = build('calendar', 'v3', credentials=credentials)
-                    
-                    event = task_genie.db.db[collection].find_one({'_id': ObjectId(document_id)})
-                    if event and 'google_event_id' in event:
-                        service.events().delete(
-                            calendarId='primary',
-                            eventId=event['google_event_id']
-                        ).execute()
-                except Exception as e:
-                    logger.warning(f"Failed to delete event from Google Calendar: {str(e)}")
-            
-            result = task_genie.db.db[collection].delete_one(
-                {'_id': ObjectId(document_id)}
-            )
+                sync_with_google_calendar(collection, [], deleted=[event])
+            
+            result = task_genie.db.delete_document(collection, document_id)
             
             if result.deleted_count != 1:
                 return jsonify({'error': 'Failed to delete the document'}), 400
                 
             # Reschedule and sync tasks
-            reschedule_and_sync_tasks()
+            reschedule_and_sync_tasks(previous_document=event)
             
             return jsonify({
                 'message': 'Successfully deleted the document',
@@ -630,8 +558,6 @@ def confirm_action():
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        task_genie.db.close()
 
 @app.route('/get_calendar_events', methods=['POST'])
 def get_calendar_events():
@@ -644,21 +570,19 @@ def get_calendar_events():
         if not all([user_name, start_date, end_date]):
             return jsonify({'error': 'Missing required fields'}), 400
             
-        task_genie.db.connect()
-            
         # Query events
         events_query = {
-            'User': {'$regex': f"\\b{re.escape(user_name)}\\b", '$options': 'i'},
+            'user_key': normalize_user_key(user_name),
             'Start Time': {
                 '$gte': start_date,
                 '$lte': end_date
             }
         }
-        events = task_genie.db.execute_query('events', events_query)
+        events = task_genie.db.execute_query('events', events_query, CALENDAR_EVENT_FIELDS)
         
         # Query tasks
         tasks_query = {
-            'User': {'$regex': f"\\b{re.escape(user_name)}\\b", '$options': 'i'},
+            'user_key': normalize_user_key(user_name),
             '$or': [
                 {'Start Time': {
                     '$gte': start_date,
@@ -670,7 +594,7 @@ def get_calendar_events():
                 }}
             ]
         }
-        tasks = task_genie.db.execute_query('tasks', tasks_query)
+        tasks = task_genie.db.execute_query('tasks', tasks_query, CALENDAR_TASK_FIELDS)
 
         # Serialize documents
         events = task_genie.task_scheduler.serialize_document(events)
@@ -679,7 +603,7 @@ def get_calendar_events():
         # Format dates in events and tasks
         formatted_events = []
         for event in events:
-            event_copy = {k: v for k, v in event.items() if k != 'key_embedding'}
+            event_copy = dict(event)
             event_copy['_id'] = str(event_copy['_id']) if '_id' in event_copy else None
             
             # Ensure google_event_id exists
@@ -698,7 +622,7 @@ def get_calendar_events():
 
         formatted_tasks = []
         for task in tasks:
-            task_copy = {k: v for k, v in task.items() if k != 'key_embedding'}
+            task_copy = dict(task)
             task_copy['_id'] = str(task_copy['_id']) if '_id' in task_copy else None
             
             # Ensure google_event_id exists
@@ -725,8 +649,6 @@ def get_calendar_events():
     except Exception as e:
         logger.error(f"Error getting calendar events: {str(e)}")
         return jsonify({'error': str(e)}), 500
-    finally:
-        task_genie.db.close()
 
 def refresh_google_credentials():
     """Helper function to check and refresh Google credentials"""
@@ -754,44 +676,6 @@ def refresh_google_credentials():
         logger.error(f"Error refreshing credentials: {str(e)}")
         return None
 
-def process_google_calendar_event(google_event, user_name, db):
-    """Process a single Google Calendar event"""
-    if 'dateTime' not in google_event['start'] and 'dateTime' not in google_event['start']:
-        return
-
-    start = google_event['start'].get('dateTime')
-    end = google_event['end'].get('dateTime')
-    
-    if not start or not end:
-        raise KeyError("Missing start or end time")
-
-    # Parse datetime with or without time component
-    start_dt = datetime.fromisoformat(start)
-    end_dt = datetime.fromisoformat(end)
-    
-    start_time = start_dt.strftime('%Y-%m-%d %H:%M:%S')
-    end_time = end_dt.strftime('%Y-%m-%d %H:%M:%S')
-    
-    db_event = {
-        'User': user_name,
-        'Title': google_event.get('summary', 'Untitled Event'),
-        'Description': google_event.get('description', ''),
-        'Start Time': start_time,
-        'End Time': end_time,
-        'Location': google_event.get('location', ''),
-        'google_event_id': google_event['id']
-    }
-    
-    # Update or insert event
-    db.db['events'].update_one(
-        {
-            'google_event_id': google_event['id'],
-            'User': user_name
-        },
-        {'$set': db_event},
-        upsert=True
-    )
-
 def sync_mongodb_event_to_google(mongo_event, service, google_events_dict):
     """Sync a single MongoDB event to Google Calendar"""
     try:
@@ -853,5 +737,19 @@ def sync_mongodb_event_to_google(mongo_event, service, google_events_dict):
         raise
 
 
+@app.cli.command('init-db')
+def init_db():
+    """Backfill user keys and create the per-user lookup indexes"""
+    prepare_database()
+
+def prepare_database():
+    """Run the database upkeep explicitly at startup instead of on import"""
+    try:
+        task_genie.db.prepare()
+    except Exception as e:
+        logger.error(f"Failed to prepare database indexes: {str(e)}")
+
+
 if __name__ == '__main__':
+    prepare_database()
     app.run(debug=True)
\ No newline at end of file
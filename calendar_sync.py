@@ -0,0 +1,267 @@
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, UpdateOne
+
+from taskgenie import normalize_user_key
+
+logger = logging.getLogger(__name__)
+
+
+def to_calendar_event(document: Dict, time_zone: str = 'America/New_York') -> Dict:
+    """Build the Google Calendar event body for an event or task document"""
+    start_time = datetime.fromisoformat(document['Start Time'].replace('Z', '+00:00'))
+    end_time = datetime.fromisoformat(document['End Time'].replace('Z', '+00:00'))
+
+    return {
+        'summary': document['Title'],
+        'description': document.get('Description') or '',
+        'start': {
+            'dateTime': start_time.isoformat(),
+            'timeZone': time_zone,
+        },
+        'end': {
+            'dateTime': end_time.isoformat(),
+            'timeZone': time_zone,
+        },
+        'location': document.get('Location') or '',
+        'reminders': {
+            'useDefault': True
+        }
+    }
+
+
+def from_calendar_event(google_event: Dict, user_name: str) -> Optional[Dict]:
+    """Build the MongoDB event document for a Google Calendar event, or None for all-day events"""
+    start = google_event.get('start', {}).get('dateTime')
+    end = google_event.get('end', {}).get('dateTime')
+    if not start or not end:
+        return None
+
+    return {
+        'User': user_name,
+        'user_key': normalize_user_key(user_name),
+        'Title': google_event.get('summary', 'Untitled Event'),
+        'Description': google_event.get('description', ''),
+        'Start Time': datetime.fromisoformat(start).strftime('%Y-%m-%d %H:%M:%S'),
+        'End Time': datetime.fromisoformat(end).strftime('%Y-%m-%d %H:%M:%S'),
+        'Location': google_event.get('location', ''),
+        'google_event_id': google_event['id'],
+        # Picked up by the embedding pipeline after the import
+        'embedding_dirty': True
+    }
+
+
+def content_hash(calendar_event: Dict) -> str:
+    return hashlib.sha256(json.dumps(calendar_event, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class CalendarSync:
+    """Diff-based push of MongoDB documents to Google Calendar using batch HTTP requests"""
+    # The Calendar API accepts at most 50 calls per batch request
+    BATCH_LIMIT = 50
+    PAGE_SIZE = 250
+    STATE_COLLECTION = 'calendar_sync_state'
+    # How far back a full import reaches
+    FULL_SYNC_DAYS = 30
+
+    def __init__(self, service, db, calendar_id: str = 'primary'):
+        self.service = service
+        self.db = db
+        self.calendar_id = calendar_id
+
+    def sync(self, collection: str, documents: List[Dict], deleted: List[Dict] = ()) -> Dict:
+        stats = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0, 'failed': 0}
+        inserts, updates, deletes = [], [], []
+
+        for document in documents:
+            try:
+                calendar_event = to_calendar_event(document)
+            except (KeyError, TypeError, AttributeError, ValueError) as e:
+                logger.warning(f"Skipping {document.get('_id')} in calendar sync: {str(e)}")
+                stats['failed'] += 1
+                continue
+            digest = content_hash(calendar_event)
+            if document.get('google_event_id') and document.get('google_sync_hash') == digest:
+                stats['unchanged'] += 1
+            elif document.get('google_event_id'):
+                updates.append((document, calendar_event, digest))
+            else:
+                inserts.append((document, calendar_event, digest))
+
+        for document in deleted:
+            if document and document.get('google_event_id'):
+                deletes.append(document)
+
+        synced = []
+        events = self.service.events()
+
+        # Events that vanished from Google Calendar are recreated, as the per-event sync used to do
+        missing = []
+        for (document, calendar_event, digest), (response, error) in zip(updates, self._execute([
+                events.update(calendarId=self.calendar_id, eventId=document['google_event_id'], body=calendar_event)
+                for document, calendar_event, _ in updates])):
+            if error is None:
+                synced.append((document, response['id'], digest))
+                stats['updated'] += 1
+            elif self._status(error) in (404, 410):
+                missing.append((document, calendar_event, digest))
+            else:
+                logger.error(f"Failed to update calendar event for {document.get('_id')}: {str(error)}")
+                stats['failed'] += 1
+
+        inserts += missing
+        for (document, calendar_event, digest), (response, error) in zip(inserts, self._execute([
+                events.insert(calendarId=self.calendar_id, body=calendar_event)
+                for _, calendar_event, _ in inserts])):
+            if error is None:
+                synced.append((document, response['id'], digest))
+                stats['inserted'] += 1
+            else:
+                logger.error(f"Failed to insert calendar event for {document.get('_id')}: {str(error)}")
+                stats['failed'] += 1
+
+        cleared = []
+        for document, (_, error) in zip(deletes, self._execute([
+                events.delete(calendarId=self.calendar_id, eventId=document['google_event_id'])
+                for document in deletes])):
+            if error is None or self._status(error) in (404, 410):
+                cleared.append(document)
+                stats['deleted'] += 1
+            else:
+                logger.error(f"Failed to delete calendar event {document['google_event_id']}: {str(error)}")
+                stats['failed'] += 1
+
+        operations = []
+        for document, google_event_id, digest in synced:
+            document['google_event_id'] = google_event_id
+            document['google_sync_hash'] = digest
+            if document.get('_id'):
+                operations.append(UpdateOne(
+                    {'_id': ObjectId(document['_id'])},
+                    {'$set': {'google_event_id': google_event_id, 'google_sync_hash': digest}}
+                ))
+        # Documents that stay in MongoDB (e.g. unscheduled tasks) must not point at the removed event
+        for document in cleared:
+            if document.get('_id'):
+                operations.append(UpdateOne(
+                    {'_id': ObjectId(document['_id'])},
+                    {'$unset': {'google_event_id': '', 'google_sync_hash': ''}}
+                ))
+        if operations:
+            self.db.bulk_write(collection, operations)
+
+        logger.info(f"Calendar sync for {collection}: {stats}")
+        return stats
+
+    def pull(self, user_name: str) -> Dict:
+        """Import Google Calendar changes for a user since the stored sync token"""
+        user_key = normalize_user_key(user_name)
+        state = self.db.db[self.STATE_COLLECTION].find_one({'user_key': user_key}) or {}
+        sync_token = state.get('sync_token')
+
+        try:
+            google_events, next_sync_token = self._list_events(sync_token)
+        except Exception as e:
+            # An expired token (410 Gone) means Google wants a fresh full sync
+            if sync_token is None or self._status(e) != 410:
+                raise
+            logger.info(f"Sync token for {user_name} expired, running a full calendar import")
+            sync_token = None
+            google_events, next_sync_token = self._list_events(None)
+
+        # Tasks are pushed to Google as events; their calendar copies must not come back as events
+        task_event_ids = {
+            task['google_event_id'] for task in self.db.db['tasks'].find(
+                {'user_key': user_key, 'google_event_id': {'$ne': None}}, {'google_event_id': 1}
+            )
+        }
+
+        stats = {'upserted': 0, 'deleted': 0, 'skipped': 0, 'full': sync_token is None}
+        operations, seen, removed = [], [], []
+        for google_event in google_events:
+            if google_event['id'] in task_event_ids:
+                stats['skipped'] += 1
+                continue
+            document = None
+            if google_event.get('status') != 'cancelled':
+                try:
+                    document = from_calendar_event(google_event, user_name)
+                except (KeyError, ValueError) as e:
+                    logger.warning(f"Skipping event due to invalid field: {str(e)}")
+            if document is None:
+                removed.append(google_event['id'])
+                operations.append(DeleteOne({'user_key': user_key, 'google_event_id': google_event['id']}))
+                stats['deleted'] += 1
+                continue
+            seen.append(google_event['id'])
+            operations.append(UpdateOne(
+                {'user_key': user_key, 'google_event_id': google_event['id']},
+                {'$set': document},
+                upsert=True
+            ))
+            stats['upserted'] += 1
+
+        deleted_filters = [{'google_event_id': {'$in': removed}}] if removed else []
+        if sync_token is None:
+            # A full import replaces whatever was previously imported from Google
+            stale = {'google_event_id': {'$exists': True, '$ne': None, '$nin': seen}}
+            operations.append(DeleteMany({'user_key': user_key, **stale}))
+            deleted_filters.append(stale)
+        # Read the ids first so the vector index can drop the deleted documents too
+        deleted_ids = [document['_id'] for document in self.db.db['events'].find(
+            {'user_key': user_key, '$or': deleted_filters}, {'_id': 1})] if deleted_filters else []
+
+        if operations:
+            self.db.bulk_write('events', operations)
+        for document_id in deleted_ids:
+            self.db.vector_backend.discard('events', document_id)
+        if next_sync_token:
+            self.db.db[self.STATE_COLLECTION].update_one(
+                {'user_key': user_key},
+                {'$set': {'sync_token': next_sync_token, 'updated_at': datetime.utcnow()}},
+                upsert=True
+            )
+
+        logger.info(f"Calendar import for {user_name}: {stats}")
+        return stats
+
+    def _list_events(self, sync_token: Optional[str]):
+        # Page through events.list and return (events, nextSyncToken)
+        params = {'calendarId': self.calendar_id, 'singleEvents': True, 'maxResults': self.PAGE_SIZE}
+        if sync_token:
+            params['syncToken'] = sync_token
+        else:
+            time_min = datetime.utcnow() - timedelta(days=self.FULL_SYNC_DAYS)
+            params['timeMin'] = time_min.isoformat() + 'Z'
+
+        google_events = []
+        while True:
+            result = self.service.events().list(**params).execute()
+            google_events.extend(result.get('items', []))
+            if not result.get('nextPageToken'):
+                return google_events, result.get('nextSyncToken')
+            params['pageToken'] = result['nextPageToken']
+
+    def _execute(self, requests: List) -> List:
+        # Run requests in batches and return (response, error) pairs in request order
+        results = [(None, None)] * len(requests)
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = (response, exception)
+
+        for offset in range(0, len(requests), self.BATCH_LIMIT):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for index in range(offset, min(offset + self.BATCH_LIMIT, len(requests))):
+                batch.add(requests[index], request_id=str(index))
+            batch.execute()
+        return results
+
+    @staticmethod
+    def _status(error):
+        resp = getattr(error, 'resp', None)
+        return getattr(resp, 'status', None)
@@ -1,24 +1,42 @@
 import asyncio
+import argparse
 import os
+import sys
 import ast
 import re
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import openai
 from openai import OpenAI, AzureOpenAI
 import logging
 import time
+import bisect
+import itertools
+import math
+import random
+import hashlib
+import sqlite3
+import threading
+import queue
 import numpy as np
 import pandas as pd
 from bson import ObjectId, json_util
 from typing import Dict, List, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from pymongo import MongoClient, UpdateOne
+from pymongo import ASCENDING, DESCENDING, MongoClient, UpdateOne
 from pymongo.server_api import ServerApi
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import certifi
-from pymongo.errors import PyMongoError
+from pymongo.errors import OperationFailure, PyMongoError
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -32,37 +50,291 @@ class MongoJSONEncoder(json.JSONEncoder):
             return o.isoformat()
         return json.JSONEncoder.default(self, o)
 
+def normalize_user_key(user_name: str) -> str:
+    # Case- and whitespace-insensitive form of a user name, stored as `user_key` for indexed equality lookups
+    return ' '.join(str(user_name).split()).casefold()
+
+def with_user_key(document: Dict) -> Dict:
+    if document.get('User') is not None:
+        document['user_key'] = normalize_user_key(document['User'])
+    return document
+
 class Database:
-    def __init__(self, uri: str):
+    USER_COLLECTIONS = ('events', 'tasks', 'user_preference')
+    # Every regular index the query paths rely on: (keys, options) per collection
+    INDEXES = {
+        'events': [
+            ([('user_key', ASCENDING), ('Start Time', ASCENDING)], {}),
+            ([('user_key', ASCENDING), ('End Time', ASCENDING)], {}),
+            # Upsert key of the Google Calendar import
+            ([('user_key', ASCENDING), ('google_event_id', ASCENDING)], {}),
+        ],
+        'tasks': [
+            ([('user_key', ASCENDING), ('Due Date', ASCENDING)], {}),
+            ([('user_key', ASCENDING), ('Start Time', ASCENDING)], {}),
+            ([('user_key', ASCENDING), ('google_event_id', ASCENDING)], {}),
+        ],
+        'user_preference': [
+            ([('user_key', ASCENDING)], {}),
+        ],
+        'calendar_sync_state': [
+            ([('user_key', ASCENDING)], {'unique': True, 'sparse': True}),
+        ],
+    }
+    # Stored fields no reader needs back; the 1536-float embedding alone is ~12KB per document
+    DEFAULT_PROJECTION = {'key_embedding': 0}
+    # Atlas Search indexes used by $vectorSearch; these are managed in Atlas, not created here
+    SEARCH_INDEXES = {'events': 'key_index', 'tasks': 'key_index_task'}
+    # One marker document per applied data migration, keyed by migration name
+    MIGRATIONS_COLLECTION = 'migrations'
+
+    def __init__(self, uri: str, max_pool_size: int = 50, min_pool_size: int = 0,
+                 health_check_interval: float = 30.0, vector_backend: str = 'atlas',
+                 vector_partitions: int = 0, batch_size: int = 200):
         self.uri = uri
+        # Documents per cursor batch; bounds how much of a result set is held in memory at once
+        self.batch_size = batch_size
+        # Set by TaskGenieApp; receives the ids of written documents that need new embeddings
+        self.embedding_pipeline = None
+        if vector_backend == 'local':
+            self.vector_backend = LocalVectorIndex(self, partitions=vector_partitions)
+        elif vector_backend == 'atlas':
+            self.vector_backend = AtlasVectorBackend(self)
+        else:
+            raise ValueError(f"Unknown vector backend: {vector_backend}")
+        self.max_pool_size = max_pool_size
+        self.min_pool_size = min_pool_size
+        self.health_check_interval = health_check_interval
         self.client = None
-        self.db = None
+        self.healthy = False
+        self._db = None
+        self._lock = threading.Lock()
+        self._stop_health_check = threading.Event()
+        self._health_thread = None
+
+    @property
+    def db(self):
+        # Connect lazily on first use; afterwards every caller shares the same pooled client
+        if self._db is None:
+            self.connect()
+        return self._db
 
     def connect(self):
-        try:
-            self.client = MongoClient(self.uri, server_api=ServerApi('1'), tlsCAFile=certifi.where())
-            self.db = self.client['sample_db']
-            self.client.admin.command('ping')
-            # logger.info("Successfully connected to MongoDB!")
-            return self.db
-        except Exception as e:
-            raise ConnectionError(f"Failed to connect to MongoDB: {str(e)}")
+        if self._db is not None:
+            return self._db
+        with self._lock:
+            if self._db is not None:
+                return self._db
+            try:
+                client = MongoClient(
+                    self.uri,
+                    server_api=ServerApi('1'),
+                    tlsCAFile=certifi.where(),
+                    maxPoolSize=self.max_pool_size,
+                    minPoolSize=self.min_pool_size,
+                )
+                client.admin.command('ping')
+                self.client = client
+                self._db = client['sample_db']
+                self.healthy = True
+                self._start_health_check()
+                # logger.info("Successfully connected to MongoDB!")
+                return self._db
+            except Exception as e:
+                raise ConnectionError(f"Failed to connect to MongoDB: {str(e)}")
+
+    def _start_health_check(self):
+        if self.health_check_interval <= 0:
+            return
+        self._stop_health_check.clear()
+        self._health_thread = threading.Thread(
+            target=self._health_check_loop, name="mongodb-health-check", daemon=True)
+        self._health_thread.start()
+
+    def _health_check_loop(self):
+        while not self._stop_health_check.wait(self.health_check_interval):
+            client = self.client
+            if client is None:
+                return
+            try:
+                client.admin.command('ping')
+                if not self.healthy:
+                    logger.info("MongoDB connection recovered")
+                self.healthy = True
+            except Exception as e:
+                # The driver reconnects on its own; we only track the state for diagnostics
+                if self.healthy:
+                    logger.warning(f"MongoDB health check failed: {str(e)}")
+                self.healthy = False
 
     def close(self):
-        if self.client:
-            self.client.close()
+        with self._lock:
+            self._stop_health_check.set()
+            if self.client:
+                self.client.close()
+            self.client = None
+            self._db = None
+            self.healthy = False
+
+    def prepare(self):
+        # Startup upkeep for explicit entry points (CLI, `flask init-db`), never run at import
+        self.migrate_user_keys()
+        self.ensure_indexes()
+
+    def migrate_user_keys(self):
+        # One-time backfill of `user_key` for documents written before the field existed. Every
+        # later write sets the field itself, so once the marker exists this is a single lookup.
+        migrations = self.db[self.MIGRATIONS_COLLECTION]
+        if migrations.find_one({'_id': 'user_key'}) is not None:
+            return
+        for collection in self.USER_COLLECTIONS:
+            operations = [
+                UpdateOne({'_id': document['_id']}, {'$set': {'user_key': normalize_user_key(document['User'])}})
+                for document in self.db[collection].find(
+                    {'user_key': {'$exists': False}, 'User': {'$type': 'string'}}, {'User': 1})
+            ]
+            if operations:
+                self.bulk_write(collection, operations)
+                logger.info(f"Backfilled user_key on {len(operations)} {collection} documents")
+        migrations.update_one(
+            {'_id': 'user_key'},
+            {'$setOnInsert': {'applied_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}},
+            upsert=True)
+
+    def ensure_indexes(self):
+        # create_index is a no-op when an identical index already exists, so this is safe on every startup
+        for collection, indexes in self.INDEXES.items():
+            for keys, options in indexes:
+                try:
+                    self.db[collection].create_index(keys, **options)
+                except PyMongoError as e:
+                    logger.warning(f"Could not create index {keys} on {collection}: {str(e)}")
+
+        for collection, index in self.SEARCH_INDEXES.items():
+            try:
+                specs = {spec.get('name'): spec for spec in self.db[collection].list_search_indexes()}
+            except PyMongoError as e:
+                logger.warning(f"Could not list search indexes on {collection}: {str(e)}")
+                continue
+            if index not in specs:
+                logger.warning(f"Vector search index '{index}' is missing on {collection}")
+                continue
+            fields = specs[index].get('latestDefinition', {}).get('fields', [])
+            filter_paths = {field.get('path') for field in fields if field.get('type') == 'filter'}
+            missing = [path for path in AtlasVectorBackend.FILTER_FIELDS if path not in filter_paths]
+            if missing:
+                logger.warning(f"Vector search index '{index}' does not declare filter fields {missing}; "
+                               f"similarity search will fall back to post-filtering")
+
+    @staticmethod
+    def query_shapes(user_key: str, now: str) -> List[Tuple[str, str, Dict]]:
+        # Representative filters for every query the app issues, as (name, collection, filter)
+        return [
+            ('events in time range', 'events',
+             {'user_key': user_key, 'Start Time': {'$gte': now, '$lte': now}}),
+            ('events overlapping a time', 'events',
+             {'user_key': user_key, 'Start Time': {'$lte': now}, 'End Time': {'$gte': now}}),
+            ('upcoming events', 'events', {'user_key': user_key, 'Start Time': {'$gte': now}}),
+            ('google import upsert', 'events', {'user_key': user_key, 'google_event_id': 'probe'}),
+            ('all user tasks', 'tasks', {'user_key': user_key}),
+            ('open tasks', 'tasks', {'user_key': user_key, 'Due Date': {'$gte': now}}),
+            ('calendar view tasks', 'tasks',
+             {'user_key': user_key, '$or': [{'Start Time': {'$gte': now, '$lte': now}},
+                                            {'Due Date': {'$gte': now, '$lte': now}}]}),
+            ('synced tasks', 'tasks', {'user_key': user_key, 'google_event_id': {'$ne': None}}),
+            ('user preference', 'user_preference', {'user_key': user_key}),
+            ('calendar sync state', 'calendar_sync_state', {'user_key': user_key}),
+        ]
+
+    def explain_query_shapes(self, user_name: str = 'probe') -> List[Dict]:
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        report = []
+        for name, collection, query in self.query_shapes(normalize_user_key(user_name), now):
+            plan = self.db[collection].find(query).explain().get('queryPlanner', {})
+            stages = list(self._plan_stages(plan.get('winningPlan', {})))
+            report.append({
+                'name': name,
+                'collection': collection,
+                'stages': stages,
+                'collscan': 'COLLSCAN' in stages,
+            })
+        return report
+
+    @classmethod
+    def _plan_stages(cls, plan: Dict):
+        # Walk a winning plan (classic or slot-based engine) and yield its stage names
+        if not isinstance(plan, dict):
+            return
+        if 'stage' in plan:
+            yield plan['stage']
+        for key in ('queryPlan', 'inputStage'):
+            if key in plan:
+                yield from cls._plan_stages(plan[key])
+        for child in plan.get('inputStages', []):
+            yield from cls._plan_stages(child)
 
     def add_document(self, collection: str, document: dict):
         try:
+            with_user_key(document)
+            EmbeddingPipeline.mark_dirty(collection, document)
             result = self.db[collection].insert_one(document)
+            self.vector_backend.upsert(collection, document)
+            if self.embedding_pipeline and document.get('embedding_dirty'):
+                self.embedding_pipeline.submit(collection, result.inserted_id)
             return result.inserted_id
         except PyMongoError as e:
             logger.error(f"Error during insert operation: {str(e)}")
             raise
 
-    def execute_query(self, collection_name: str, query: Dict) -> List[Dict]:
-        collection = self.db[collection_name]
-        return list(collection.find(query))
+    def update_document(self, collection: str, document_id, fields: Dict):
+        try:
+            with_user_key(fields)
+            EmbeddingPipeline.mark_dirty(collection, fields)
+            result = self.db[collection].update_one({'_id': ObjectId(document_id)}, {'$set': fields})
+            self.vector_backend.upsert(collection, dict(fields, _id=ObjectId(document_id)))
+            if self.embedding_pipeline and fields.get('embedding_dirty'):
+                self.embedding_pipeline.submit(collection, document_id)
+            return result
+        except PyMongoError as e:
+            logger.error(f"Error during update operation: {str(e)}")
+            raise
+
+    def delete_document(self, collection: str, document_id):
+        try:
+            result = self.db[collection].delete_one({'_id': ObjectId(document_id)})
+            self.vector_backend.discard(collection, document_id)
+            return result
+        except PyMongoError as e:
+            logger.error(f"Error during delete operation: {str(e)}")
+            raise
+
+    @classmethod
+    def build_projection(cls, projection=None) -> Dict:
+        # None drops the heavy fields, a list of names keeps only those fields (plus _id),
+        # and a dict is passed to MongoDB unchanged
+        if projection is None:
+            return cls.DEFAULT_PROJECTION
+        if isinstance(projection, dict):
+            return projection
+        return {field: 1 for field in projection}
+
+    def iter_query(self, collection_name: str, query: Dict, projection=None, sort: List[Tuple[str, int]] = None,
+                   limit: int = 0, skip: int = 0, batch_size: int = None):
+        # Stream matching documents from a server-side cursor; sorting, limits and pages are applied
+        # by MongoDB, so with a matching index only the requested window is ever read
+        cursor = self.db[collection_name].find(
+            query, self.build_projection(projection), batch_size=batch_size or self.batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def execute_query(self, collection_name: str, query: Dict, projection=None,
+                      sort: List[Tuple[str, int]] = None, limit: int = 0, skip: int = 0) -> List[Dict]:
+        return list(self.iter_query(collection_name, query, projection, sort, limit, skip))
 
     def bulk_write(self, collection: str, operations: List[UpdateOne]):
         try:
@@ -76,45 +348,8 @@ class Database:
     async def find_similar_documents(self, embedding, filter_criteria, collections_name: str, num_results: int = 5):
         try:
             if filter_criteria:
-                collection = self.db[collections_name]
-                index = "key_index" if collections_name == 'events' else "key_index_task"
-
-                pipeline = [
-                    {
-                        "$vectorSearch": {
-                            "queryVector": embedding,
-                            "path": "key_embedding",
-                            "numCandidates": 1536,
-                            "limit": num_results,
-                            "index": index,
-                        }
-                    },
-                    {
-                        "$match": filter_criteria
-                    },
-                    {
-                        "$project": {
-                            "User": 1,
-                            "Title": 1,
-                            "Description": 1,
-                            "Start Time": 1,
-                            "End Time": 1,
-                            "Due Date": 1,
-                            "Duration": 1,
-                            "Location": 1,
-                            "search_score": { "$meta": "vectorSearchScore" }
-                        }
-                    },
-                    {
-                        "$sort": {
-                            "Start Time": 1,
-                            "Due Date": 1,
-                        }
-                    }
-                ]
-
-                documents = collection.aggregate(pipeline)
-                return list(documents)
+                return await asyncio.to_thread(
+                    self.vector_backend.search, embedding, filter_criteria, collections_name, num_results)
             else:
                 return list()
 
@@ -122,6 +357,406 @@ class Database:
             logger.error(f"Error in finding similar docs: {str(e)}")
             raise
 
+class AtlasVectorBackend:
+    # Vector search through the Atlas `$vectorSearch` stage and the key_index/key_index_task indexes.
+    # The user is passed as a pre-filter, which needs user_key declared as a "filter" field in the
+    # index definition; plain user searches use ANN with a candidate pool sized to the request.
+    # Conditions on other fields, such as the string time ranges Atlas cannot pre-filter on, are
+    # matched after an exact search over the user's documents.
+    RESULT_FIELDS = ["User", "Title", "Description", "Start Time", "End Time", "Due Date", "Duration", "Location"]
+    FILTER_FIELDS = ['user_key']
+    CANDIDATES_PER_RESULT = 20
+    MAX_CANDIDATES = 10000
+    # How Atlas reports a pre-filter on a path the index does not declare as a filter field
+    UNINDEXED_FILTER = re.compile(r"needs to be indexed as (token|filter)", re.IGNORECASE)
+
+    def __init__(self, database: Database):
+        self.database = database
+        # Cleared when Atlas rejects the pre-filter, i.e. the index lacks the filter fields
+        self.prefilter = True
+
+    def search(self, embedding, filter_criteria: Dict, collection_name: str, num_results: int) -> List[Dict]:
+        collection = self.database.db[collection_name]
+        index = "key_index" if collection_name == 'events' else "key_index_task"
+        prefilter = {field: value for field, value in filter_criteria.items() if field in self.FILTER_FIELDS}
+        post_filter = {field: value for field, value in filter_criteria.items() if field not in self.FILTER_FIELDS}
+
+        vector_search = {
+            "queryVector": embedding,
+            "path": "key_embedding",
+            "limit": num_results,
+            "index": index,
+        }
+        if self.prefilter and prefilter:
+            vector_search["filter"] = prefilter
+            if post_filter:
+                # Rank all of the user's documents so the post-filter cannot starve the result
+                vector_search["exact"] = True
+                vector_search["limit"] = self.MAX_CANDIDATES
+            else:
+                vector_search["numCandidates"] = self.num_candidates(num_results)
+            try:
+                pipeline = self._pipeline(vector_search, post_filter)
+                if post_filter:
+                    pipeline.insert(-1, {"$limit": num_results})
+                return list(collection.aggregate(pipeline))
+            except OperationFailure as e:
+                # Only a missing filter declaration is permanent; anything else is left to the caller
+                if not self.UNINDEXED_FILTER.search(str(e)):
+                    raise
+                logger.warning(f"Vector index {index} does not declare the filter fields {self.FILTER_FIELDS}, "
+                               f"post-filtering searches from now on: {str(e)}")
+                self.prefilter = False
+                del vector_search["filter"]
+                vector_search.pop("exact", None)
+                vector_search["limit"] = num_results
+
+        # Without a pre-filter the ANN pool has to cover other users' documents as well
+        vector_search["numCandidates"] = self.MAX_CANDIDATES
+        vector_search["limit"] = min(self.MAX_CANDIDATES, num_results * 4)
+        pipeline = self._pipeline(vector_search, filter_criteria)
+        pipeline.insert(-1, {"$limit": num_results})
+        return list(collection.aggregate(pipeline))
+
+    @classmethod
+    def num_candidates(cls, num_results: int) -> int:
+        # ~20 candidates per requested result
+        return max(num_results, min(num_results * cls.CANDIDATES_PER_RESULT, cls.MAX_CANDIDATES))
+
+    def _pipeline(self, vector_search: Dict, post_filter: Dict = None) -> List[Dict]:
+        pipeline = [{"$vectorSearch": vector_search}]
+        if post_filter:
+            pipeline.append({"$match": post_filter})
+        pipeline += [
+            {
+                "$project": {
+                    **{field: 1 for field in self.RESULT_FIELDS},
+                    "search_score": { "$meta": "vectorSearchScore" }
+                }
+            },
+            {
+                "$sort": {
+                    "Start Time": 1,
+                    "Due Date": 1,
+                }
+            }
+        ]
+        return pipeline
+
+    # Atlas maintains its indexes itself
+    def upsert(self, collection_name: str, document: Dict):
+        pass
+
+    def discard(self, collection_name: str, document_id):
+        pass
+
+class VectorSet:
+    # Unit-normalized float32 rows for one user's documents, with an optional IVF-style partitioning
+    def __init__(self, ids: List[str], vectors: List[List[float]]):
+        self.ids = list(ids)
+        self.rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        if self.ids:
+            self.matrix = self._normalize(np.asarray(vectors, dtype=np.float32).reshape(len(self.ids), -1))
+        else:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.centroids = None
+        self.assignments = None
+
+    @staticmethod
+    def _normalize(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def upsert(self, doc_id: str, vector: List[float]):
+        row = self._normalize(np.asarray(vector, dtype=np.float32))
+        if doc_id in self.rows:
+            self.matrix[self.rows[doc_id]] = row
+        elif self.ids and row.shape[0] != self.matrix.shape[1]:
+            raise ValueError(f"Embedding dimension {row.shape[0]} does not match {self.matrix.shape[1]}")
+        else:
+            self.rows[doc_id] = len(self.ids)
+            self.ids.append(doc_id)
+            self.matrix = np.vstack([self.matrix.reshape(len(self.ids) - 1, row.shape[0]), row[None, :]])
+        self.centroids = None
+
+    def discard(self, doc_id: str):
+        row = self.rows.pop(doc_id, None)
+        if row is None:
+            return
+        self.matrix = np.delete(self.matrix, row, axis=0)
+        del self.ids[row]
+        self.rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        self.centroids = None
+
+    def partition(self, partitions: int, iterations: int = 8):
+        # A few rounds of spherical k-means; each row is assigned to its most similar centroid
+        rng = np.random.default_rng(0)
+        centroids = self.matrix[rng.choice(len(self.ids), partitions, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(self.matrix @ centroids.T, axis=1)
+            for k in range(partitions):
+                members = self.matrix[assignments == k]
+                if len(members):
+                    centroids[k] = members.sum(axis=0)
+            centroids = self._normalize(centroids)
+        self.centroids = centroids
+        self.assignments = np.argmax(self.matrix @ centroids.T, axis=1)
+
+    def search(self, query: np.ndarray, num_results: int, candidates: List[str] = None,
+               partitions: int = 0, probes: int = 2) -> List[Tuple[str, float]]:
+        if not self.ids:
+            return []
+        if candidates is not None:
+            rows = np.array([self.rows[doc_id] for doc_id in candidates if doc_id in self.rows], dtype=np.intp)
+        elif partitions and len(self.ids) > partitions * 32:
+            if self.centroids is None:
+                self.partition(partitions)
+            nearest = np.argsort(-(self.centroids @ query))[:probes]
+            rows = np.flatnonzero(np.isin(self.assignments, nearest))
+        else:
+            rows = np.arange(len(self.ids))
+        if rows.size == 0:
+            return []
+
+        scores = self.matrix[rows] @ query
+        top = np.argpartition(-scores, min(num_results, rows.size) - 1)[:num_results]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[rows[i]], float(scores[i])) for i in top]
+
+class LocalVectorIndex:
+    # In-process cosine search over key_embedding. Each user's vectors are loaded from MongoDB
+    # on first use and patched by Database.add_document/update_document/delete_document, so a
+    # search costs one matrix product plus a single _id lookup for the matching documents.
+    # Scores follow Atlas' cosine vectorSearchScore, (1 + cosine) / 2.
+    RESULT_FIELDS = AtlasVectorBackend.RESULT_FIELDS
+
+    def __init__(self, database: Database, partitions: int = 0, probes: int = 2):
+        self.database = database
+        self.partitions = partitions
+        self.probes = probes
+        self._sets = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def search(self, embedding, filter_criteria: Dict, collection_name: str, num_results: int) -> List[Dict]:
+        user_key, candidates = self._parse_filter(collection_name, filter_criteria)
+        query = VectorSet._normalize(np.asarray(embedding, dtype=np.float32))
+        with self._lock:
+            vector_set = self._vector_set(collection_name, user_key)
+            matches = vector_set.search(query, num_results, candidates, self.partitions, self.probes)
+        if not matches:
+            return []
+
+        scores = dict(matches)
+        documents = self.database.execute_query(
+            collection_name, {'_id': {'$in': [ObjectId(doc_id) for doc_id in scores]}}, self.RESULT_FIELDS)
+        for document in documents:
+            document['search_score'] = (1 + scores[str(document['_id'])]) / 2
+        return sorted(documents, key=lambda x: (x.get('Start Time') or '', x.get('Due Date') or ''))
+
+    def _parse_filter(self, collection_name: str, filter_criteria: Dict):
+        # A user, plus any other MongoDB conditions (e.g. a time range), which are resolved to
+        # candidate ids through the regular indexes
+        if not isinstance(filter_criteria.get('user_key'), str):
+            raise ValueError(f"Local vector search needs a user_key filter, got: {sorted(filter_criteria)}")
+        if set(filter_criteria) == {'user_key'}:
+            return filter_criteria['user_key'], None
+        candidates = [str(document['_id'])
+                      for document in self.database.iter_query(collection_name, filter_criteria, ['_id'])]
+        return filter_criteria['user_key'], candidates
+
+    def _vector_set(self, collection_name: str, user_key: str) -> VectorSet:
+        key = (collection_name, user_key)
+        if key not in self._sets:
+            documents = self.database.execute_query(
+                collection_name,
+                {'user_key': user_key, 'key_embedding': {'$type': 'array'}},
+                {'key_embedding': 1}
+            )
+            self._sets[key] = VectorSet([str(d['_id']) for d in documents], [d['key_embedding'] for d in documents])
+            for document in documents:
+                self._owners[(collection_name, str(document['_id']))] = user_key
+        return self._sets[key]
+
+    def upsert(self, collection_name: str, document: Dict):
+        if document.get('_id') is None:
+            return
+        doc_id = str(document['_id'])
+        with self._lock:
+            previous_owner = self._owners.get((collection_name, doc_id))
+            user_key = document.get('user_key', previous_owner)
+            if previous_owner is not None and previous_owner != user_key:
+                self._sets[(collection_name, previous_owner)].discard(doc_id)
+            # Sets that are not loaded yet will read the document from MongoDB when first used
+            vector_set = self._sets.get((collection_name, user_key))
+            if vector_set is None or document.get('key_embedding') is None:
+                return
+            vector_set.upsert(doc_id, document['key_embedding'])
+            self._owners[(collection_name, doc_id)] = user_key
+
+    def discard(self, collection_name: str, document_id):
+        doc_id = str(document_id)
+        with self._lock:
+            user_key = self._owners.pop((collection_name, doc_id), None)
+            if user_key is not None and (collection_name, user_key) in self._sets:
+                self._sets[(collection_name, user_key)].discard(doc_id)
+
+class HitCounter:
+    # Thread-safe hit/miss counters behind the stats() of every cache
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def record(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hit_rate, 4)}
+
+class LRUCache(HitCounter):
+    # Bounded mapping that drops its least recently used entries. `on_evict(key, value)` runs under
+    # the lock for each entry pushed out by the size bound; callers take `lock` for compound updates.
+    def __init__(self, max_size: int, on_evict=None):
+        super().__init__()
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key):
+        # Like get, but without touching the hit/miss counters
+        with self.lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def get(self, key):
+        with self.lock:
+            value = self.lookup(key)
+            self.record(value is not None)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.evictions += 1
+                if self.on_evict is not None:
+                    self.on_evict(evicted_key, evicted)
+
+    def pop(self, key):
+        with self.lock:
+            return self._entries.pop(key, None)
+
+    def items(self) -> List[Tuple]:
+        with self.lock:
+            return list(self._entries.items())
+
+    def stats(self) -> Dict:
+        return {"size": len(self._entries), **super().stats(), "evictions": self.evictions}
+
+class EmbeddingCache:
+    # Content-addressed embedding store: an in-memory LRU in front of an optional SQLite file
+    # holding float32 vectors, so repeated phrases never hit the embeddings endpoint twice.
+    def __init__(self, max_size: int = 1024, path: str = None):
+        self.max_size = max_size
+        self.path = path
+        self._entries = LRUCache(max_size)
+        self._conn = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, vector BLOB)")
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text.strip()}".encode('utf-8')).hexdigest()
+
+    def get(self, model: str, text: str):
+        key = self.make_key(model, text)
+        with self._entries.lock:
+            vector = self._entries.lookup(key)
+            if vector is None and self._conn is not None:
+                row = self._conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row:
+                    vector = np.frombuffer(row[0], dtype=np.float32)
+                    self._entries.put(key, vector)
+            self._entries.record(vector is not None)
+            return vector.tolist() if vector is not None else None
+
+    def put(self, model: str, text: str, embedding: List[float]):
+        key = self.make_key(model, text)
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._entries.lock:
+            self._entries.put(key, vector)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, model, vector) VALUES (?, ?, ?)",
+                    (key, model, vector.tobytes()))
+                self._conn.commit()
+
+    def stats(self) -> Dict:
+        return self._entries.stats()
+
+
+class RateLimiter:
+    # Sliding one-minute window over request and token budgets, shared by every LLM caller
+    def __init__(self, requests_per_minute: int = 500, tokens_per_minute: int = 200000):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._window = deque()
+        self._tokens_in_window = 0
+        self._condition = threading.Condition()
+
+    def _purge(self, now: float):
+        while self._window and now - self._window[0][0] >= 60:
+            _, tokens = self._window.popleft()
+            self._tokens_in_window -= tokens
+            self._condition.notify_all()
+
+    def acquire(self, tokens: int):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._purge(now)
+                within_requests = len(self._window) < self.requests_per_minute
+                # An oversized request is let through on an empty window instead of waiting forever
+                within_tokens = self._tokens_in_window + tokens <= self.tokens_per_minute or not self._window
+                if within_requests and within_tokens:
+                    entry = [now, tokens]
+                    self._window.append(entry)
+                    self._tokens_in_window += tokens
+                    return entry
+                self._condition.wait(timeout=max(0.05, 60 - (now - self._window[0][0])))
+
+    def record_usage(self, entry, actual_tokens: int):
+        # Replace the up-front estimate with the usage the API reported
+        with self._condition:
+            self._purge(time.monotonic())
+            if time.monotonic() - entry[0] < 60:
+                self._tokens_in_window += actual_tokens - entry[1]
+                entry[1] = actual_tokens
+                self._condition.notify_all()
+
+
 class OpenAIService:
     # def __init__(self, azure_endpoint: str, api_key: str, api_version: str):
     #     self.client = AzureOpenAI(
@@ -129,10 +764,35 @@ class OpenAIService:
     #         api_key=api_key,  
     #         api_version=api_version
     #     )
-    def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
+    EMBEDDING_MODEL = "text-embedding-ada-002"
+    # Inputs per embeddings request; the API accepts up to 2048
+    EMBEDDING_BATCH_SIZE = 256
+    CHAT_MODEL = "gpt-4o-mini"
+    MAX_RETRIES = 3
+    MAX_BACKOFF = 30
+    # Completion tokens reserved per request before the real usage is known
+    COMPLETION_TOKEN_ESTIMATE = 512
+
+    def __init__(self, api_key: str, embedding_cache: EmbeddingCache = None, rate_limiter: RateLimiter = None,
+                 max_workers: int = 8):
+        # Retries are handled here so they go through the rate limiter and jittered backoff
+        self.client = OpenAI(api_key=api_key, max_retries=0)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm")
+        self.embedding_cache = embedding_cache or EmbeddingCache()
+        # Reuse TCP/TLS connections to the embeddings endpoint across requests
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
 
     async def get_embedding(self, query: str) -> List[float]:
+        return await asyncio.to_thread(self._request_embedding, query)
+
+    def _request_embedding(self, query: str) -> List[float]:
+        cached = self.embedding_cache.get(self.EMBEDDING_MODEL, query)
+        logger.info(f"Embedding cache {'hit' if cached is not None else 'miss'}: {self.embedding_cache.stats()}")
+        if cached is not None:
+            return cached
+
         url = 'https://api.openai.com/v1/embeddings'
         headers = {
             'Authorization': f'Bearer {os.getenv("OPENAI_API_KEY")}',
@@ -140,32 +800,126 @@ class OpenAIService:
         }
         data = {
             "input": query,
-            "model": "text-embedding-ada-002"
+            "model": self.EMBEDDING_MODEL
         }
-        response = requests.post(url, headers=headers, json=data)
+        response = self.session.post(url, headers=headers, json=data, timeout=30)
         if response.status_code == 200:
-            return response.json()['data'][0]['embedding']
+            embedding = response.json()['data'][0]['embedding']
+            self.embedding_cache.put(self.EMBEDDING_MODEL, query, embedding)
+            return embedding
         else:
             raise Exception(f"Failed to get embedding. Status code: {response.status_code}")
 
-    def create_chat_completion(self, prompt: str, system_content: str, temperature: float = 0) -> str:
-        max_retries = 3
-        for attempt in range(max_retries):
+    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        # Embed many texts with one request per EMBEDDING_BATCH_SIZE inputs; cached texts are not resent
+        embeddings = {text: self.embedding_cache.get(self.EMBEDDING_MODEL, text) for text in texts}
+        missing = [text for text, embedding in embeddings.items() if embedding is None]
+        logger.info(f"Embedding cache served {len(embeddings) - len(missing)} of {len(embeddings)} texts: "
+                    f"{self.embedding_cache.stats()}")
+
+        url = 'https://api.openai.com/v1/embeddings'
+        headers = {
+            'Authorization': f'Bearer {os.getenv("OPENAI_API_KEY")}',
+            'Content-Type': 'application/json'
+        }
+        for offset in range(0, len(missing), self.EMBEDDING_BATCH_SIZE):
+            batch = missing[offset:offset + self.EMBEDDING_BATCH_SIZE]
+            response = self.session.post(url, headers=headers, json={"input": batch, "model": self.EMBEDDING_MODEL},
+                                         timeout=60)
+            if response.status_code != 200:
+                raise Exception(f"Failed to get embeddings. Status code: {response.status_code}")
+            for item in response.json()['data']:
+                text = batch[item['index']]
+                embeddings[text] = item['embedding']
+                self.embedding_cache.put(self.EMBEDDING_MODEL, text, item['embedding'])
+        return [embeddings[text] for text in texts]
+
+    def map_concurrently(self, func, items: List) -> List:
+        # Run func over items on the shared LLM executor; results keep the input order
+        futures = [self.executor.submit(func, item) for item in items]
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def estimate_tokens(messages: List[Dict]) -> int:
+        return sum(len(message["content"]) for message in messages) // 4 + len(messages) * 4
+
+    def _backoff_delay(self, attempt: int, error: Exception) -> float:
+        # Full jitter keeps concurrent callers that failed together from retrying in lockstep
+        delay = random.uniform(0, min(self.MAX_BACKOFF, 2 ** (attempt + 1)))
+        if isinstance(error, openai.RateLimitError):
+            response = getattr(error, 'response', None)
+            retry_after = response.headers.get('retry-after') if response is not None else None
+            try:
+                delay = max(delay, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+        return delay
+
+    def _complete(self, messages: List[Dict], temperature: float, response_format: Dict = None) -> str:
+        for attempt in range(self.MAX_RETRIES):
+            entry = self.rate_limiter.acquire(self.estimate_tokens(messages) + self.COMPLETION_TOKEN_ESTIMATE)
             try:
                 response = self.client.chat.completions.create(
-                    model="gpt-4o-mini",
+                    model=self.CHAT_MODEL,
                     temperature=temperature,
-                    messages=[
-                        {"role": "system", "content": system_content},
-                        {"role": "user", "content": prompt}
-                    ],
-                    
+                    messages=messages,
+                    **({'response_format': response_format} if response_format else {})
                 )
+                if getattr(response, 'usage', None):
+                    self.rate_limiter.record_usage(entry, response.usage.total_tokens)
                 return response.choices[0].message.content.strip()
             except Exception as e:
-                if attempt == max_retries - 1:
-                    raise RuntimeError(f"Failed after {max_retries} attempts: {str(e)}")
-                time.sleep(2 ** attempt)
+                if attempt == self.MAX_RETRIES - 1:
+                    raise RuntimeError(f"Failed after {self.MAX_RETRIES} attempts: {str(e)}")
+                # Only this caller sleeps; other requests keep flowing through the limiter
+                time.sleep(self._backoff_delay(attempt, e))
+
+    def create_chat_completion(self, prompt: str, system_content: str, temperature: float = 0) -> str:
+        return self._complete([
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": prompt}
+        ], temperature)
+
+    def create_structured_completion(self, prompt: str, system_content: str, schema: Dict, name: str,
+                                     temperature: float = 0) -> Dict:
+        # Structured outputs constrain the reply to the JSON schema, so it parses without any cleanup
+        response = self._complete([
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": prompt}
+        ], temperature, response_format={
+            "type": "json_schema",
+            "json_schema": {"name": name, "strict": True, "schema": schema}
+        })
+        return json.loads(response)
+
+    def stream_chat_completion(self, prompt: str, system_content: str, temperature: float = 0):
+        # Yield the answer in chunks as they arrive; a failed attempt is only retried before the first chunk
+        messages = [
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": prompt}
+        ]
+        for attempt in range(self.MAX_RETRIES):
+            entry = self.rate_limiter.acquire(self.estimate_tokens(messages) + self.COMPLETION_TOKEN_ESTIMATE)
+            started = False
+            try:
+                stream = self.client.chat.completions.create(
+                    model=self.CHAT_MODEL,
+                    temperature=temperature,
+                    messages=messages,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
+                for chunk in stream:
+                    if getattr(chunk, 'usage', None):
+                        self.rate_limiter.record_usage(entry, chunk.usage.total_tokens)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        started = True
+                        yield chunk.choices[0].delta.content
+                return
+            except Exception as e:
+                if started or attempt == self.MAX_RETRIES - 1:
+                    raise RuntimeError(f"Streaming failed after {attempt + 1} attempts: {str(e)}")
+                time.sleep(self._backoff_delay(attempt, e))
 
     def create_chat_conversation(self, prompt: str, system_content: str, conversation_history: list = None, temperature: float = 0):
         if conversation_history is None:
@@ -175,37 +929,770 @@ class OpenAIService:
         messages.extend(conversation_history)
         messages.append({"role": "user", "content": prompt})
         
-        max_retries = 3
-        for attempt in range(max_retries):
+        response_content = self._complete(messages, temperature)
+        conversation_history.append({"role": "user", "content": prompt})
+        conversation_history.append({"role": "assistant", "content": response_content})
+        
+        return response_content, conversation_history
+
+class TimeExpressionParser:
+    # Resolves common time expressions locally, following the conventions documented in the
+    # QueryProcessor prompts. Anything it cannot fully interpret returns None so the caller
+    # falls back to LLM code generation.
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+    WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+    NUMBER_WORDS = {'a': 1, 'an': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5,
+                    'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10}
+    NUMBER = r'(\d+|a|an|one|two|three|four|five|six|seven|eight|nine|ten)'
+
+    # Start hour for scheduling, as listed in the event prompt
+    TIME_OF_DAY = [
+        ('early morning', 7), ('late morning', 11), ('morning', 9), ('noon', 12), ('midday', 12),
+        ('early afternoon', 13), ('late afternoon', 16), ('afternoon', 14), ('early evening', 17),
+        ('evening', 18), ('late night', 22), ('tonight', 20), ('night', 20),
+    ]
+    # Query windows (start hour, end hour) for the same names
+    TIME_OF_DAY_WINDOWS = {'morning': (6, 12), 'afternoon': (12, 18), 'evening': (18, 24),
+                           'tonight': (18, 24), 'night': (18, 24)}
+    EVENT_DURATIONS = [
+        (r'\b(quick|catch[- ]?up|check[- ]?in|stand[- ]?up)\b', 15),
+        (r'\b(coffee|lunch)\b', 30),
+        (r'\b(doctor|dentist|medical|physician)\b', 30),
+        (r'\binterview\b', 45),
+        (r'\b(workshop|training)\b', 120),
+        (r'\b(gym|workout|exercise)\b', 90),
+    ]
+    DEFAULT_EVENT_DURATION = 60
+
+    PAST_TENSE = re.compile(r"\b(did|done|was|were|had|happened|completed|finished|attended|went)\b")
+    TEMPORAL_CUE = re.compile(
+        r"\b(today|tonight|tomorrow|tmrw?|yesterday|weeks?|weekends?|months?|years?|quarter|days?|"
+        r"mondays?|tuesdays?|wednesdays?|thursdays?|fridays?|saturdays?|sundays?|"
+        r"mon|tue|tues|wed|thu|thur|thurs|fri|sat|sun|"
+        r"january|february|march|april|june|july|august|september|october|november|december|"
+        r"jan|feb|mar|apr|jun|jul|aug|sep|sept|oct|nov|dec|"
+        r"morning|afternoon|evening|night|noon|midday|midnight|eod|eow|"
+        r"hours?|hrs?|minutes?|mins?|ago|last|past|previous|before|after|until|till|since|"
+        r"between|during|every|daily|weekly|monthly|am|pm)\b|\d"
+    )
+    QUERY_FUTURE_TEMPLATES = [
+        r"^(show|list|display|what|what is|what are)( me)?( all)?( my)? (schedule|tasks|events|calendar|agenda|plans)$",
+        r"^(show |show me )?what (is )?(coming|coming up|upcoming|next)$",
+        r"^(show|list)( me)? (the )?things to do next$",
+    ]
+    QUERY_ALL_TEMPLATES = [
+        r"^what (tasks|things) do i (still )?have left( to (complete|do|finish))?$",
+    ]
+
+    def __init__(self):
+        # A hit is an expression resolved locally, a miss one left to the LLM
+        self.counter = HitCounter()
+
+    @property
+    def hit_rate(self) -> float:
+        return self.counter.hit_rate
+
+    def stats(self) -> Dict:
+        return self.counter.stats()
+
+    def _record(self, result):
+        self.counter.record(result is not None)
+        logger.info(f"Time expression parser {'hit' if result is not None else 'miss'}: {self.stats()}")
+        return result
+
+    # Parsing helpers
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        text = text.lower().replace('’', "'")
+        text = re.sub(r'\b([ap])\.m\.?', r'\1m', text)
+        text = re.sub(r"'s\b", '', text)
+        text = re.sub(r"[?!,;\"'()]|\.(?!\d)", ' ', text)
+        return re.sub(r'\s+', ' ', text).strip()
+
+    @classmethod
+    def _number(cls, token: str) -> int:
+        return int(token) if token.isdigit() else cls.NUMBER_WORDS[token]
+
+    @staticmethod
+    def _consume(text: str, match) -> str:
+        # Repeated mentions ("tomorrow (any time tomorrow)") refer to the same expression
+        text = f"{text[:match.start()]} {text[match.end():]}"
+        return re.sub(rf'\b{re.escape(match.group(0).strip())}\b', ' ', text)
+
+    @staticmethod
+    def _midnight(dt: datetime) -> datetime:
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def _end_of_day(dt: datetime) -> datetime:
+        return dt.replace(hour=23, minute=59, second=59, microsecond=0)
+
+    @classmethod
+    def _start_of_week(cls, now: datetime) -> datetime:
+        return cls._midnight(now - timedelta(days=now.weekday()))
+
+    def _extract_day(self, text: str, now: datetime, past: bool = False):
+        today = self._midnight(now)
+        match = re.search(r'\b(the )?day after (tomorrow|tmrw?)\b', text)
+        if match:
+            return today + timedelta(days=2), self._consume(text, match)
+        match = re.search(r'\b(tomorrow|tmrw?)\b', text)
+        if match:
+            return today + timedelta(days=1), self._consume(text, match)
+        match = re.search(r'\b(today|tonight)\b', text)
+        if match:
+            # "tonight" also names a time of day, so leave it for the time-of-day pass
+            remaining = text if match.group(1) == 'tonight' else self._consume(text, match)
+            return today, remaining
+        match = re.search(r'\byesterday\b', text)
+        if match:
+            return today - timedelta(days=1), self._consume(text, match)
+        match = re.search(rf'\bin {self.NUMBER} days?( from now| time)?\b|\b{self.NUMBER} days? from (now|today)\b', text)
+        if match:
+            days = self._number(match.group(1) or match.group(3))
+            return today + timedelta(days=days), self._consume(text, match)
+        match = re.search(rf'\b(on |this |coming |this coming |next |last )?({"|".join(self.WEEKDAYS)})\b', text)
+        if match:
+            modifier = (match.group(1) or '').strip()
+            weekday = self.WEEKDAYS.index(match.group(2))
+            if modifier == 'next':
+                days = (weekday - now.weekday()) % 7 + 7
+            elif modifier == 'last':
+                days = -((now.weekday() - weekday) % 7 or 7)
+            else:
+                days = (weekday - now.weekday()) % 7
+                if past and days > 0:
+                    days -= 7
+            return today + timedelta(days=days), self._consume(text, match)
+        return None, text
+
+    @staticmethod
+    def _to_hour(hour: int, meridiem: str):
+        if meridiem == 'am':
+            return 0 if hour == 12 else hour
+        if meridiem == 'pm':
+            return hour if hour == 12 else hour + 12
+        return hour
+
+    def _extract_clock_range(self, text: str):
+        clock = r'(\d{1,2})(?::([0-5]\d))?\s*(am|pm)?'
+        match = re.search(rf'\b(?:from |between )?{clock}\s*(?:-|to|until|till|and)\s*{clock}\b', text)
+        if not match:
+            return None, None, text
+        h1, m1, mer1, h2, m2, mer2 = match.groups()
+        if not (mer1 or mer2 or m1 or m2):
+            return None, None, text
+        end = (self._to_hour(int(h2), mer2), int(m2 or 0))
+        # "2 to 4pm" shares the end's meridiem, but "11 to 1pm" does not; leave that one to the LLM
+        start = (self._to_hour(int(h1), mer1 or mer2), int(m1 or 0))
+        if not all(0 <= h < 24 for h, _ in (start, end)) or start >= end:
+            return None, None, text
+        return start, end, self._consume(text, match)
+
+    def _extract_clock(self, text: str):
+        match = re.search(r'\b(?:at |by |for |before )?(\d{1,2})(?::([0-5]\d))?\s*(am|pm)\b', text)
+        if match:
+            hour = int(match.group(1))
+            if 1 <= hour <= 12:
+                return (self._to_hour(hour, match.group(3)), int(match.group(2) or 0)), self._consume(text, match)
+            return None, text
+        match = re.search(r'\b(?:at |by |for |before )?([01]?\d|2[0-3]):([0-5]\d)\b', text)
+        if match:
+            return (int(match.group(1)), int(match.group(2))), self._consume(text, match)
+        match = re.search(r'\b(?:at |by |for |before )?(noon|midday)\b', text)
+        if match:
+            return (12, 0), self._consume(text, match)
+        return None, text
+
+    def _extract_time_of_day(self, text: str):
+        for name, _ in self.TIME_OF_DAY:
+            match = re.search(rf'\b(?:this |in the |at )?{name}\b', text)
+            if match:
+                return name, self._consume(text, match)
+        return None, text
+
+    def _extract_duration(self, text: str):
+        minutes = 0
+        match = re.search(r'\b(?:for )?(half an hour|half-hour|half hour)\b', text)
+        if match:
+            minutes += 30
+            text = self._consume(text, match)
+        match = re.search(r'\b(?:for )?(\d+(?:\.\d+)?|a|an|one|two|three|four|five|six|seven|eight|nine|ten)[\s-]*(hours?|hrs?)(?:[\s-]long)?\b', text)
+        if match:
+            value = match.group(1)
+            minutes += int(float(value) * 60) if value[0].isdigit() else self._number(value) * 60
+            text = self._consume(text, match)
+        match = re.search(r'\b(?:for )?(\d+)[\s-]*(minutes?|mins?)(?:[\s-]long)?\b', text)
+        if match:
+            minutes += int(match.group(1))
+            text = self._consume(text, match)
+        return (minutes or None), text
+
+    def _upcoming(self, moment: datetime, text: str, now: datetime):
+        # Scheduling only looks ahead: a bare weekday naming today ("on friday at 9am" on a Friday
+        # afternoon) means next week's; any other time already past is left to the LLM
+        if moment > now:
+            return moment
+        if moment.date() == now.date() and not re.search(r'\b(today|tonight)\b', text) \
+                and re.search(rf'\b({"|".join(self.WEEKDAYS)})\b', text):
+            return moment + timedelta(days=7)
+        return None
+
+    def _has_unparsed_cues(self, text: str) -> bool:
+        return bool(self.TEMPORAL_CUE.search(text))
+
+    def _format(self, dt: datetime) -> str:
+        return dt.strftime(self.TIME_FORMAT)
+
+    # Public entry points
+
+    def parse_query(self, natural_query: str, now: datetime = None):
+        return self._record(self._parse_query(natural_query, now or datetime.now()))
+
+    def _parse_query(self, natural_query: str, now: datetime):
+        text = self._normalize(natural_query)
+        if any(re.match(pattern, text) for pattern in self.QUERY_ALL_TEMPLATES):
+            return {}
+        if any(re.match(pattern, text) for pattern in self.QUERY_FUTURE_TEMPLATES):
+            return {"Start Time": {"$gte": self._format(now)}}
+
+        past = bool(self.PAST_TENSE.search(text))
+        start = end = None
+        week_start = self._start_of_week(now)
+        month_start = self._midnight(now.replace(day=1))
+
+        ranges = [
+            (r'\bnext week\b', lambda: (week_start + timedelta(days=7), week_start + timedelta(days=14))),
+            (r'\blast week\b', lambda: (week_start - timedelta(days=7), week_start)),
+            (r'\b(this|the) week\b', lambda: (week_start, now if past else week_start + timedelta(days=7))),
+            (r'\b(this |the )?weekend\b', lambda: (week_start + timedelta(days=5), week_start + timedelta(days=7))),
+            (r'\bnext month\b', lambda: (month_start + relativedelta(months=1), month_start + relativedelta(months=2))),
+            (r'\blast month\b', lambda: (month_start - relativedelta(months=1), month_start)),
+            (r'\b(this|the) month\b', lambda: (month_start, now if past else month_start + relativedelta(months=1))),
+        ]
+        for pattern, window in ranges:
+            match = re.search(pattern, text)
+            if match:
+                start, end = window()
+                text = self._consume(text, match)
+                break
+
+        if start is None:
+            match = re.search(rf'\b(?:in |within |over |during )?the (next|coming|past|last) {self.NUMBER} days\b', text)
+            if match:
+                days = self._number(match.group(2))
+                if match.group(1) in ('next', 'coming'):
+                    start, end = now, self._end_of_day(now + timedelta(days=days))
+                else:
+                    start, end = self._midnight(now - timedelta(days=days)), now
+                text = self._consume(text, match)
+
+        if start is None:
+            day, text = self._extract_day(text, now, past)
+            part, text = self._extract_time_of_day(text)
+            if part is not None and part not in self.TIME_OF_DAY_WINDOWS:
+                return None
+            if day is None and part is None:
+                return None
+            if part is not None:
+                day = day or self._midnight(now)
+                window_start, window_end = self.TIME_OF_DAY_WINDOWS[part]
+                start = day + timedelta(hours=window_start)
+                end = day + timedelta(hours=window_end) - (timedelta(seconds=1) if window_end == 24 else timedelta(0))
+                if day == self._midnight(now):
+                    start = start if past else max(start, now)
+                    end = min(end, now) if past else end
+                    if start > end:
+                        # The window is entirely on the other side of now; let the LLM decide
+                        return None
+            else:
+                start, end = day, self._end_of_day(day)
+                if past and day == self._midnight(now):
+                    end = now
+
+        if self._has_unparsed_cues(text):
+            return None
+        return {
+            "Start Time": {"$gte": self._format(start)},
+            "End Time": {"$lte": self._format(end)}
+        }
+
+    def parse_event_schedule(self, natural_query: str, now: datetime = None):
+        return self._record(self._parse_event_schedule(natural_query, now or datetime.now()))
+
+    def _parse_event_schedule(self, natural_query: str, now: datetime):
+        text = self._normalize(natural_query)
+        kind_text = text
+        day = None
+        for pattern, weekday in ((r'\b(at the )?beginning of (the )?week\b', 0),
+                                 (r'\bmid-?week\b', 2),
+                                 (r'\b(at the )?end of (the )?week\b', 4)):
+            match = re.search(pattern, text)
+            if match:
+                day = self._midnight(now) + timedelta(days=(weekday - now.weekday()) % 7)
+                text = self._consume(text, match)
+                break
+        if day is None:
+            day, text = self._extract_day(text, now)
+
+        start_clock, end_clock, text = self._extract_clock_range(text)
+        if start_clock is None:
+            start_clock, text = self._extract_clock(text)
+        if start_clock is None:
+            part, text = self._extract_time_of_day(text)
+            if part is not None:
+                start_clock = (dict(self.TIME_OF_DAY)[part], 0)
+        duration, text = self._extract_duration(text)
+
+        if start_clock is None or self._has_unparsed_cues(text):
+            return None
+
+        if day is None:
+            # Without a day, a time that has already passed today means tomorrow
+            day = self._midnight(now)
+            if day.replace(hour=start_clock[0], minute=start_clock[1]) <= now:
+                day += timedelta(days=1)
+        start_time = day.replace(hour=start_clock[0], minute=start_clock[1])
+        if end_clock is not None:
+            end_time = day.replace(hour=end_clock[0], minute=end_clock[1])
+        else:
+            if duration is None:
+                duration = next((minutes for pattern, minutes in self.EVENT_DURATIONS
+                                 if re.search(pattern, kind_text)), self.DEFAULT_EVENT_DURATION)
+            end_time = start_time + timedelta(minutes=duration)
+        upcoming = self._upcoming(start_time, kind_text, now)
+        if upcoming is None:
+            return None
+        end_time += upcoming - start_time
+        start_time = upcoming
+        return {
+            "Start Time": self._format(start_time),
+            "End Time": self._format(end_time)
+        }
+
+    def parse_task_schedule(self, natural_query: str, now: datetime = None):
+        return self._record(self._parse_task_schedule(natural_query, now or datetime.now()))
+
+    def _parse_task_schedule(self, natural_query: str, now: datetime):
+        text = self._normalize(natural_query)
+        original_text = text
+        due_date = None
+        # "in 2 hours" is a deadline relative to now, not the task's duration
+        match = re.search(r'\b(?:in|within) (half an hour|half-hour|half hour|'
+                          r'(\d+(?:\.\d+)?|a|an|one|two|three|four|five|six|seven|eight|nine|ten)[\s-]*(hours?|hrs?|minutes?|mins?))\b',
+                          text)
+        if match:
+            if match.group(2) is None:
+                minutes = 30
+            else:
+                value = float(match.group(2)) if match.group(2)[0].isdigit() else self._number(match.group(2))
+                minutes = value * 60 if match.group(3).startswith('h') else value
+            due_date = (now + timedelta(minutes=minutes)).replace(microsecond=0)
+            text = self._consume(text, match)
+        # The task's own duration is extracted elsewhere; drop it so it is not mistaken for a deadline
+        _, text = self._extract_duration(text)
+        if re.search(r'\b(in|within)$', text):
+            # A relative deadline the pattern above could not read
+            return None
+        today = self._midnight(now)
+        sunday = today + timedelta(days=6 - now.weekday())
+        month_start = today.replace(day=1)
+
+        deadlines = [
+            (r'\b(by |before )?(the )?end of (the )?day\b|\beod\b', lambda: self._end_of_day(today)),
+            (r'\b(by |before )?(the )?end of (the )?next week\b|\bnext week\b', lambda: self._end_of_day(sunday + timedelta(days=7))),
+            (r'\b(by |before )?(the )?end of (the |this )?week\b|\beow\b|\b(by |due |due by )?this week\b', lambda: self._end_of_day(sunday)),
+            (r'\b(by |before )?(the )?end of (the )?next month\b|\bnext month\b', lambda: self._end_of_day(month_start + relativedelta(months=2) - timedelta(days=1))),
+            (r'\b(by |before )?(the )?end of (the |this )?month\b|\b(by |due |due by )?this month\b', lambda: self._end_of_day(month_start + relativedelta(months=1) - timedelta(days=1))),
+        ]
+        for pattern, deadline in deadlines if due_date is None else []:
+            match = re.search(pattern, text)
+            if match:
+                due_date = deadline()
+                text = self._consume(text, match)
+                break
+
+        if due_date is None:
+            day, text = self._extract_day(text, now)
+            clock, text = self._extract_clock(text)
+            if clock is None:
+                part, text = self._extract_time_of_day(text)
+                if part is not None:
+                    clock = (dict(self.TIME_OF_DAY)[part], 0)
+            if day is None and clock is None:
+                # Non-specific timing defaults to the end of tomorrow
+                day = today + timedelta(days=1)
+            if day is None and clock <= (now.hour, now.minute):
+                # Without a day, a time that has already passed today means tomorrow
+                day = today + timedelta(days=1)
+            day = day or today
+            due_date = day.replace(hour=clock[0], minute=clock[1]) if clock else self._end_of_day(day)
+
+        due_date = self._upcoming(due_date, original_text, now)
+        if due_date is None or self._has_unparsed_cues(text):
+            return None
+        return {"Due Date": self._format(due_date)}
+
+
+class CompiledFunctionCache:
+    # LRU cache of compiled LLM-generated functions keyed on normalized query text. Only the code
+    # is cached, never its result, so callers re-run it on every hit and datetime.now() stays fresh.
+    FILLER_WORDS = {'please', 'can', 'could', 'would', 'you', 'tell', 'me', 'the', 'a', 'an', 'hey', 'hi'}
+
+    def __init__(self, max_size: int = 256, path: str = None):
+        self.max_size = max_size
+        self.path = path
+        self._entries = LRUCache(max_size)
+        if path:
+            self._load()
+
+    @classmethod
+    def normalize(cls, text: str) -> str:
+        text = text.lower().replace('’', "'")
+        text = re.sub(r"\bwhat's\b", 'what is', text)
+        text = re.sub(r"[^\w\s:-]", ' ', text)
+        return ' '.join(word for word in text.split() if word not in cls.FILLER_WORDS)
+
+    def get(self, text: str):
+        entry = self._entries.get(self.normalize(text))
+        return entry[1] if entry is not None else None
+
+    def put(self, text: str, source: str):
+        code = compile(source, '<generated>', 'exec')
+        key = self.normalize(text)
+        with self._entries.lock:
+            self._entries.put(key, (source, code))
+            if self.path:
+                self._save()
+        return code
+
+    def stats(self) -> Dict:
+        return self._entries.stats()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable function cache {self.path}: {str(e)}")
+            return
+        for key, source in list(stored.items())[-self.max_size:]:
             try:
-                response = self.client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    temperature=temperature,
-                    messages=messages,
-                    
-                )
-                
-                response_content = response.choices[0].message.content.strip()
-                conversation_history.append({"role": "user", "content": prompt})
-                conversation_history.append({"role": "assistant", "content": response_content})
-                
-                return response_content, conversation_history
+                self._entries.put(key, (source, compile(source, '<generated>', 'exec')))
+            except SyntaxError:
+                continue
+
+    def _save(self):
+        # Write to a temp file first so a crash never leaves a truncated cache behind
+        tmp_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump({key: source for key, (source, _) in self._entries.items()}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Failed to persist function cache {self.path}: {str(e)}")
+
+
+class ResponseCache:
+    # LRU cache of generated answers keyed on (normalized query, fingerprint of the packed results,
+    # model, temperature). Entries expire after `ttl` seconds and can be dropped per user whenever
+    # that user's data is written, so a repeated question over unchanged data skips the LLM.
+    def __init__(self, max_size: int = 512, ttl: float = 900.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = LRUCache(max_size, on_evict=self._forget)
+        self._keys_by_user = {}
+
+    @staticmethod
+    def make_key(natural_query: str, context: str, model: str, temperature: float, user_key: str = None) -> str:
+        # The user is part of the key, so each entry belongs to exactly one user's invalidation set
+        parts = [CompiledFunctionCache.normalize(natural_query), hashlib.sha256(context.encode('utf-8')).hexdigest(),
+                 model, repr(float(temperature)), user_key or '']
+        return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        with self._entries.lock:
+            entry = self._entries.lookup(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._forget(key, self._entries.pop(key))
+                entry = None
+            self._entries.record(entry is not None)
+            return entry[1] if entry is not None else None
+
+    def put(self, key: str, response: str, user_key: str = None):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        with self._entries.lock:
+            self._entries.put(key, (time.monotonic() + self.ttl, response, user_key))
+            if user_key is not None:
+                self._keys_by_user.setdefault(user_key, set()).add(key)
+
+    def invalidate_user(self, user_key: str):
+        with self._entries.lock:
+            for key in self._keys_by_user.pop(user_key, set()):
+                self._entries.pop(key)
+
+    def _forget(self, key: str, entry: Tuple):
+        # Drop a removed entry from its user's invalidation set
+        keys = self._keys_by_user.get(entry[2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[entry[2]]
+
+    def stats(self) -> Dict:
+        return self._entries.stats()
+
+class ContextPacker:
+    # Packs query results into a compact line-per-document table that fits a token budget.
+    # Events and tasks alternate, each kind in its own rank order (the vector score when present,
+    # otherwise the given time order), so neither kind crowds out the other; documents are kept
+    # until the budget runs out and the rest are dropped and counted. Columns no document fills
+    # are left out, and a section's header is only paid for once it has a line.
+    EVENT_FIELDS = ['Title', 'Start Time', 'End Time', 'Location', 'Participants', 'Description']
+    TASK_FIELDS = ['Title', 'Due Date', 'Duration', 'Priority', 'Start Time', 'End Time', 'Description']
+    MAX_FIELD_CHARS = 200
+
+    def __init__(self, max_tokens: int = 4000, model: str = "gpt-4o-mini"):
+        self.max_tokens = max_tokens
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                try:
+                    self.encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    self.encoding = tiktoken.get_encoding("o200k_base")
             except Exception as e:
-                if attempt == max_retries - 1:
-                    raise RuntimeError(f"Failed after {max_retries} attempts: {str(e)}")
-                time.sleep(2 ** attempt)
+                # tiktoken downloads its BPE files on first use, which fails offline
+                logger.warning(f"Falling back to estimated token counts: {str(e)}")
+
+    def count_tokens(self, text: str) -> int:
+        if self.encoding is None:
+            # Same rough ratio OpenAIService.estimate_tokens uses
+            return len(text) // 4 + 1
+        return len(self.encoding.encode(text))
+
+    @classmethod
+    def _cell(cls, value) -> str:
+        if isinstance(value, list):
+            value = ', '.join(str(item) for item in value if item)
+        text = ' '.join(str(value).split()) if value not in (None, '') else '-'
+        if len(text) > cls.MAX_FIELD_CHARS:
+            text = text[:cls.MAX_FIELD_CHARS - 3] + '...'
+        return text.replace('|', '/')
+
+    def pack(self, results: List[Dict]) -> Tuple[str, Dict]:
+        events = [document for document in results if 'Due Date' not in document]
+        tasks = [document for document in results if 'Due Date' in document]
+        if any('search_score' in document for document in results):
+            events = sorted(events, key=lambda x: x.get('search_score', 0), reverse=True)
+            tasks = sorted(tasks, key=lambda x: x.get('search_score', 0), reverse=True)
+        ranked = [document for pair in itertools.zip_longest(events, tasks) for document in pair
+                  if document is not None]
+
+        sections = {}
+        for name, documents, all_fields in (('Events', events, self.EVENT_FIELDS), ('Tasks', tasks, self.TASK_FIELDS)):
+            fields = [field for field in all_fields
+                      if field == 'Title' or any(document.get(field) not in (None, '', []) for document in documents)]
+            sections[name] = (fields, [])
+
+        used = 0
+        dropped = 0
+        for document in ranked:
+            name = 'Tasks' if 'Due Date' in document else 'Events'
+            fields, lines = sections[name]
+            line = ' | '.join(self._cell(document.get(field)) for field in fields)
+            tokens = self.count_tokens(line)
+            if not lines:
+                tokens += self.count_tokens(f"{name}: " + ' | '.join(fields))
+            if used + tokens > self.max_tokens:
+                dropped += 1
+                continue
+            lines.append(line)
+            used += tokens
+
+        blocks = []
+        for name, (fields, lines) in sections.items():
+            if lines:
+                blocks.append('\n'.join([f"{name}: " + ' | '.join(fields)] + lines))
+        if dropped:
+            blocks.append(f"({dropped} more matching results omitted to fit the context budget)")
+        stats = {'included': len(ranked) - dropped, 'dropped': dropped, 'tokens': used}
+        return '\n\n'.join(blocks) if blocks else "No matching events or tasks.", stats
+
+class EmbeddingPipeline:
+    # Computes key_embedding for new or changed events and tasks off the request path. Writes flag
+    # documents with `embedding_dirty` and queue their ids; a daemon thread drains the queue in
+    # batches, embeds each batch with one API call and stores the vectors with one bulk_write.
+    # The flag lets `backfill` recover anything the queue never processed, e.g. across restarts.
+    COLLECTIONS = ('events', 'tasks')
+    SOURCE_FIELDS = ['Title', 'Description', 'Location', 'Participants']
+
+    def __init__(self, db: Database, openai_service: OpenAIService, batch_size: int = 64,
+                 flush_interval: float = 1.0):
+        self.db = db
+        self.openai_service = openai_service
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def embedding_text(cls, document: Dict) -> str:
+        parts = []
+        for field in cls.SOURCE_FIELDS:
+            value = document.get(field)
+            if isinstance(value, list):
+                value = ', '.join(str(item) for item in value if item)
+            if value:
+                parts.append(f"{field}: {value}")
+        return '\n'.join(parts)
+
+    @classmethod
+    def mark_dirty(cls, collection: str, fields: Dict) -> Dict:
+        if collection in cls.COLLECTIONS and any(field in fields for field in cls.SOURCE_FIELDS):
+            fields['embedding_dirty'] = True
+        return fields
+
+    def submit(self, collection: str, document_id):
+        if collection not in self.COLLECTIONS:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="embedding-pipeline", daemon=True)
+                self._thread.start()
+        self.queue.put((collection, ObjectId(document_id)))
+
+    def submit_dirty(self, collection: str, user_key: str = None):
+        query = {'embedding_dirty': True}
+        if user_key is not None:
+            query['user_key'] = user_key
+        for document in self.db.execute_query(collection, query, ['_id']):
+            self.submit(collection, document['_id'])
+
+    def _run(self):
+        while True:
+            pending = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(pending) < self.batch_size:
+                try:
+                    pending.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            for collection in self.COLLECTIONS:
+                ids = list({doc_id for name, doc_id in pending if name == collection})
+                if not ids:
+                    continue
+                try:
+                    self.process(collection, ids)
+                except Exception as e:
+                    # Documents stay dirty, so a later backfill picks them up
+                    logger.error(f"Failed to embed {len(ids)} {collection}: {str(e)}")
+
+    def process(self, collection: str, ids: List[ObjectId]) -> int:
+        documents = self.db.execute_query(
+            collection, {'_id': {'$in': ids}}, self.SOURCE_FIELDS + ['user_key', 'embedding_hash'])
+
+        to_embed, operations = [], []
+        for document in documents:
+            text = self.embedding_text(document)
+            digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            if not text or document.get('embedding_hash') == digest:
+                operations.append(UpdateOne({'_id': document['_id']}, {'$set': {'embedding_dirty': False}}))
+            else:
+                to_embed.append((document, text, digest))
+
+        vectors = self.openai_service.get_embeddings([text for _, text, _ in to_embed]) if to_embed else []
+        for (document, _, digest), vector in zip(to_embed, vectors):
+            operations.append(UpdateOne(
+                {'_id': document['_id']},
+                {'$set': {'key_embedding': vector, 'embedding_hash': digest, 'embedding_dirty': False}}
+            ))
+
+        self.db.bulk_write(collection, operations)
+        for (document, _, _), vector in zip(to_embed, vectors):
+            self.db.vector_backend.upsert(
+                collection, {'_id': document['_id'], 'user_key': document.get('user_key'), 'key_embedding': vector})
+        return len(to_embed)
+
+    def backfill(self, collections: Tuple[str, ...] = COLLECTIONS) -> int:
+        # Embed every document that is flagged dirty or has never been embedded, synchronously
+        embedded = 0
+        for collection in collections:
+            query = {'$or': [{'embedding_dirty': True}, {'key_embedding': {'$exists': False}}]}
+            ids = [document['_id'] for document in self.db.execute_query(collection, query, ['_id'])]
+            for offset in range(0, len(ids), self.batch_size):
+                embedded += self.process(collection, ids[offset:offset + self.batch_size])
+            logger.info(f"Backfilled embeddings for {collection}: {len(ids)} checked")
+        return embedded
 
 class QueryProcessor:
-    def __init__(self, db: Database, openai_service: OpenAIService):
+    # Query results go to the LLM and back to the client, so leave out internal bookkeeping too
+    RESULT_PROJECTION = {'key_embedding': 0, 'user_key': 0, 'google_sync_hash': 0, 'embedding_dirty': 0, 'embedding_hash': 0}
+    EVENTS_SORT = [('Start Time', ASCENDING)]
+    TASKS_SORT = [('Due Date', ASCENDING)]
+    # One structured reply covering categorization, event/task split, times and fields of a message
+    EXTRACTION_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "intent": {"type": "string", "enum": ["Query", "Schedule", "Update", "Delete", "Conversation"]},
+            "event_task": {"type": ["string", "null"], "enum": ["Event", "Task", None]},
+            "title": {"type": ["string", "null"]},
+            "description": {"type": ["string", "null"]},
+            "location": {"type": ["string", "null"]},
+            "participants": {"type": ["array", "null"], "items": {"type": "string"}},
+            "start_time": {"type": ["string", "null"]},
+            "end_time": {"type": ["string", "null"]},
+            "due_date": {"type": ["string", "null"]},
+            "priority": {"type": ["string", "null"], "enum": ["High", "Medium", "Low", None]},
+            "duration_minutes": {"type": ["integer", "null"]},
+            "tags": {"type": ["array", "null"], "items": {"type": "string"}}
+        },
+        "required": ["intent", "event_task", "title", "description", "location", "participants", "start_time",
+                     "end_time", "due_date", "priority", "duration_minutes", "tags"],
+        "additionalProperties": False
+    }
+
+    def __init__(self, db: Database, openai_service: OpenAIService, time_query_cache: CompiledFunctionCache = None,
+                 result_limit: int = 50, context_packer: ContextPacker = None,
+                 response_cache: ResponseCache = None):
         self.db = db
         self.openai_service = openai_service
+        self.response_cache = response_cache or ResponseCache()
+        self.context_packer = context_packer or ContextPacker(model=openai_service.CHAT_MODEL)
+        # Events and tasks per collection forwarded to the LLM; open-ended windows keep those nearest to now
+        self.result_limit = result_limit
+        self.time_parser = TimeExpressionParser()
+        self.time_query_cache = time_query_cache or CompiledFunctionCache()
 
     def filter_user(self, query: Dict, collection_name: str, user_name: str) -> Dict:
         query = query.copy()
-        query["User"] = {"$regex": f"\\b{re.escape(user_name)}\\b", "$options": "i"}
+        query["user_key"] = normalize_user_key(user_name)
         return query
 
     def nl_to_time_query(self, natural_query: str) -> Dict:
+        query = self.time_parser.parse_query(natural_query)
+        if query is None:
+            query = self.generate_time_query(natural_query)
+
+        events_query = query.copy()
+        tasks_query = {'Due Date': {k: v for d in query.values() for k, v in d.items()}}
+        tasks_query =  {'$or': [events_query, tasks_query]}
+
+        return {"events": events_query, "tasks": tasks_query}
+
+    def generate_time_query(self, natural_query: str) -> Dict:
+        code = self.time_query_cache.get(natural_query)
+        logger.info(f"Time query cache {'hit' if code is not None else 'miss'}: {self.time_query_cache.stats()}")
+        if code is not None:
+            return self.run_time_query_code(code)
+
         now = datetime.now()
         prompt = f"""
         Current time: {now.strftime('%Y-%m-%d %H:%M:%S')}
@@ -372,6 +1859,19 @@ class QueryProcessor:
         if function_match:
             generated_function = function_match.group(1)
 
+        try:
+            # print(f"Generated Function: {generated_function}")
+            code = compile(generated_function, '<generated>', 'exec')
+        except SyntaxError as e:
+            raise RuntimeError(f"Error in generated time query function: {str(e)}")
+        query = self.run_time_query_code(code)
+
+        # Functions with hard-coded dates are only correct today, so they are not reused
+        if not re.search(r'\d{4}-\d{1,2}-\d{1,2}|datetime\(\s*\d', generated_function):
+            self.time_query_cache.put(natural_query, generated_function)
+        return query
+
+    def run_time_query_code(self, code) -> Dict:
         safe_env = {
             'datetime': datetime,
             'timedelta': timedelta,
@@ -379,19 +1879,34 @@ class QueryProcessor:
         }
 
         try:
-            # print(f"Generated Function: {generated_function}")
-            exec(generated_function, safe_env)
+            exec(code, safe_env)
             query = safe_env['generate_query']()
         except Exception as e:
             raise RuntimeError(f"Error in generated time query function: {str(e)}")
+        if not isinstance(query, dict):
+            raise RuntimeError(f"Error in generated time query function: expected a dict, got {type(query).__name__}")
+        return query
 
-        events_query = query.copy()
-        tasks_query = {'Due Date': {k: v for d in query.values() for k, v in d.items()}}
-        tasks_query =  {'$or': [events_query, tasks_query]}
+    def nl_to_time_schedule_event(self, natural_query: str) -> Dict:
+        schedule = self.time_parser.parse_event_schedule(natural_query)
+        if schedule is None:
+            schedule = self.generate_event_schedule(natural_query)
 
-        return {"events": events_query, "tasks": tasks_query}
+        try:
+            # Validate the schedule
+            start_time = datetime.strptime(schedule['Start Time'], '%Y-%m-%d %H:%M:%S')
+            end_time = datetime.strptime(schedule['End Time'], '%Y-%m-%d %H:%M:%S')
+            
+            if start_time >= end_time:
+                raise ValueError("End time must be after start time")
+            if (end_time - start_time).total_seconds() < 300:  # Minimum 5 minutes
+                raise ValueError("Event duration must be at least 5 minutes")
+                
+            return schedule
+        except Exception as e:
+            raise RuntimeError(f"Error in generated event schedule function: {str(e)}")
 
-    def nl_to_time_schedule_event(self, natural_query: str) -> Dict:
+    def generate_event_schedule(self, natural_query: str) -> Dict:
         now = datetime.now()
         prompt = f"""
         Current time: {now.strftime('%Y-%m-%d %H:%M:%S')}
@@ -541,22 +2056,28 @@ class QueryProcessor:
         try:
             print(f"Generated Function: {generated_function}")
             exec(generated_function, safe_env)
-            schedule = safe_env['generate_event_schedule']()
-            
+            return safe_env['generate_event_schedule']()
+        except Exception as e:
+            raise RuntimeError(f"Error in generated event schedule function: {str(e)}")
+
+    def nl_to_time_schedule_task(self, natural_query: str) -> Dict:
+        now = datetime.now()
+        schedule = self.time_parser.parse_task_schedule(natural_query, now)
+        if schedule is None:
+            schedule = self.generate_task_schedule(natural_query)
+
+        try:
             # Validate the schedule
-            start_time = datetime.strptime(schedule['Start Time'], '%Y-%m-%d %H:%M:%S')
-            end_time = datetime.strptime(schedule['End Time'], '%Y-%m-%d %H:%M:%S')
+            due_date = datetime.strptime(schedule['Due Date'], '%Y-%m-%d %H:%M:%S')
             
-            if start_time >= end_time:
-                raise ValueError("End time must be after start time")
-            if (end_time - start_time).total_seconds() < 300:  # Minimum 5 minutes
-                raise ValueError("Event duration must be at least 5 minutes")
+            if due_date < now:
+                raise ValueError("Due date must be in the future")
                 
             return schedule
         except Exception as e:
-            raise RuntimeError(f"Error in generated event schedule function: {str(e)}")
+            raise RuntimeError(f"Error in generated task schedule function: {str(e)}")
 
-    def nl_to_time_schedule_task(self, natural_query: str) -> Dict:
+    def generate_task_schedule(self, natural_query: str) -> Dict:
         now = datetime.now()
         prompt = f"""
         Current time: {now.strftime('%Y-%m-%d %H:%M:%S')}
@@ -674,27 +2195,62 @@ class QueryProcessor:
         try:
             # print(f"Generated Function: {generated_function}")
             exec(generated_function, safe_env)
-            schedule = safe_env['generate_task_schedule']()
-            
-            # Validate the schedule
-            due_date = datetime.strptime(schedule['Due Date'], '%Y-%m-%d %H:%M:%S')
-            
-            if due_date < now:
-                raise ValueError("Due date must be in the future")
-                
-            return schedule
+            return safe_env['generate_task_schedule']()
         except Exception as e:
             raise RuntimeError(f"Error in generated task schedule function: {str(e)}")
 
 
-    def intelligent_filter(self, natural_query: str, results: List[Dict]) -> str:
-        results_str = json.dumps(results, cls=MongoJSONEncoder)
+    FILTER_SYSTEM_CONTENT = "You are a helpful AI assistant providing schedule and task information."
+    FILTER_TEMPERATURE = 0
+
+    def intelligent_filter(self, natural_query: str, results: List[Dict], user_name: str = None) -> str:
+        user_key = normalize_user_key(user_name) if user_name else None
+        prompt, cache_key = self.filter_request(natural_query, results, user_key)
+        cached = self.cached_answer(cache_key)
+        if cached is not None:
+            return cached
+        response = self.openai_service.create_chat_completion(
+            prompt, self.FILTER_SYSTEM_CONTENT, self.FILTER_TEMPERATURE)
+        self.response_cache.put(cache_key, response, user_key)
+        return response
+
+    def intelligent_filter_stream(self, natural_query: str, results: List[Dict], user_name: str = None):
+        # Same answer as intelligent_filter, yielded chunk by chunk as the model generates it
+        user_key = normalize_user_key(user_name) if user_name else None
+        prompt, cache_key = self.filter_request(natural_query, results, user_key)
+        cached = self.cached_answer(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        chunks = []
+        for chunk in self.openai_service.stream_chat_completion(
+                prompt, self.FILTER_SYSTEM_CONTENT, self.FILTER_TEMPERATURE):
+            chunks.append(chunk)
+            yield chunk
+        self.response_cache.put(cache_key, ''.join(chunks).strip(), user_key)
+
+    def cached_answer(self, cache_key: str):
+        cached = self.response_cache.get(cache_key)
+        logger.info(f"Response cache {'hit' if cached is not None else 'miss'}: {self.response_cache.stats()}")
+        return cached
+
+    def filter_request(self, natural_query: str, results: List[Dict], user_key: str = None) -> Tuple[str, str]:
+        # The packed results are exactly what the model sees, so they double as the result fingerprint
+        results_str, stats = self.context_packer.pack(results)
+        logger.info(f"Context packer kept {stats['included']} of {len(results)} results "
+                    f"({stats['tokens']} tokens, {stats['dropped']} dropped)")
+        cache_key = ResponseCache.make_key(
+            natural_query, results_str, self.openai_service.CHAT_MODEL, self.FILTER_TEMPERATURE, user_key)
+        return self.filter_prompt(natural_query, results_str), cache_key
+
+    def filter_prompt(self, natural_query: str, results_str: str) -> str:
         prompt = f"""
         You are an AI assistant specializing in schedule and task management. Your goal is to analyze and interpret query results based on a user's natural language input. Provide a clear, concise, and human-friendly response that directly addresses the user's needs.
 
         Context:
         - Original Query: "{natural_query}"
-        - Query Results: {results_str}
+        - Query Results (one per line, columns as in each header):
+{results_str}
 
         Instructions:
         1. Analyze the query results in the context of the original query, do not omit any tasks or events.
@@ -733,48 +2289,57 @@ class QueryProcessor:
 
         Remember: Provide only the analysis and response. Do not include any meta-text about the prompt or your role.
         """
-        return self.openai_service.create_chat_completion(
-            prompt, "You are a helpful AI assistant providing schedule and task information.")
+        return prompt
 
     async def process_query(self, user_name: str, natural_query: str, precise: bool = False) -> Tuple[List[Dict], str]:
-        mongodb_query = self.nl_to_time_query(natural_query)
-        events_time_query = mongodb_query["events"]
-        tasks_time_query = mongodb_query["tasks"]
-
-        events_query = self.filter_user(events_time_query, 'events', user_name)
-        tasks_query = self.filter_user(tasks_time_query, 'tasks', user_name)
-
-        logger.info(f"Events Time Query: {json.dumps(events_query, indent=2)}")
-        logger.info(f"Tasks Time Query: {json.dumps(tasks_query, indent=2)}")
-
-        events_filtered = self.db.execute_query('events', events_query)
-        tasks_filtered = self.db.execute_query('tasks', tasks_query)
-
-        events_filtered = sorted([{k: v for k, v in d.items() if k != 'key_embedding'}
-                                for d in events_filtered], key=lambda x: x.get('Start Time'))
-        tasks_filtered = sorted([{k: v for k, v in d.items() if k != 'key_embedding'}
-                               for d in tasks_filtered], key=lambda x: x.get('Due Date'))
+        combined_results = await self.retrieve(user_name, natural_query, precise)
+        filtered_results = await asyncio.to_thread(self.intelligent_filter, natural_query, combined_results, user_name)
+        return combined_results, filtered_results
 
-        all_filtered_docs = events_filtered + tasks_filtered
+    async def retrieve(self, user_name: str, natural_query: str, precise: bool = False) -> List[Dict]:
+        # The embedding only depends on the query text, so fetch it while the time filter is resolved
+        embedding_task = asyncio.create_task(self.openai_service.get_embedding(natural_query)) if precise else None
 
-        print(f"All filtered docs: {all_filtered_docs}")
+        try:
+            mongodb_query = await asyncio.to_thread(self.nl_to_time_query, natural_query)
+            events_time_query = mongodb_query["events"]
+            tasks_time_query = mongodb_query["tasks"]
+
+            events_query = self.filter_user(events_time_query, 'events', user_name)
+            tasks_query = self.filter_user(tasks_time_query, 'tasks', user_name)
+
+            logger.info(f"Events Time Query: {json.dumps(events_query, indent=2)}")
+            logger.info(f"Tasks Time Query: {json.dumps(tasks_query, indent=2)}")
+
+            if not precise:
+                # Windows without a start would otherwise hand the LLM the oldest documents only
+                fetch = self.fetch_serialized if self.has_lower_bound(events_time_query) else self.fetch_nearest
+                events_filtered, tasks_filtered = await asyncio.gather(
+                    asyncio.to_thread(fetch, 'events', events_query, self.RESULT_PROJECTION, self.EVENTS_SORT,
+                                      self.result_limit),
+                    asyncio.to_thread(fetch, 'tasks', tasks_query, self.RESULT_PROJECTION, self.TASKS_SORT,
+                                      self.result_limit)
+                )
+        except BaseException:
+            if embedding_task:
+                embedding_task.cancel()
+            raise
 
         # keywords = ["task", "event", "thing", "plan", "activity", "schedule", "doing"]
         # keywords = []
         # pattern = r'(' + '|'.join(re.escape(keyword) for keyword in keywords) + r')' 
         # if re.search(pattern, natural_query.lower()):
         if not precise:
-            serialized_doc_event = self.serialize_document(events_filtered)
-            serialized_doc_task = self.serialize_document(tasks_filtered)
-            combined_results = sorted(serialized_doc_event, key=lambda x: x.get('Start Time')) + sorted(serialized_doc_task, key=lambda x: x.get('Due Date'))
+            logger.info(f"Time filter matched {len(events_filtered)} events and {len(tasks_filtered)} tasks")
+            combined_results = events_filtered + tasks_filtered
         else:
             try:
-                id_list = [doc['_id'] for doc in all_filtered_docs] if all_filtered_docs else []
-                filter_criteria = {"_id": {"$in": id_list}} if id_list else {}
-                
-                embedding = await self.openai_service.get_embedding(natural_query)
-                doc_events = await self.db.find_similar_documents(embedding, filter_criteria, "events", 5)
-                doc_tasks = await self.db.find_similar_documents(embedding, filter_criteria, "tasks", 5)
+                # The time filter goes to the vector search as is, so no candidate list has to be capped
+                embedding = await embedding_task
+                doc_events, doc_tasks = await asyncio.gather(
+                    self.db.find_similar_documents(embedding, events_query, "events", 5),
+                    self.db.find_similar_documents(embedding, tasks_query, "tasks", 5)
+                )
 
                 serialized_doc_event = self.serialize_document(doc_events)
                 serialized_doc_task = self.serialize_document(doc_tasks)
@@ -785,10 +2350,38 @@ class QueryProcessor:
                 logger.error(f"Error occurred in keyword match: {str(e)}")
                 raise
 
-        filtered_results = self.intelligent_filter(natural_query, combined_results)
-        return combined_results, filtered_results
+        return combined_results
     
 
+    @staticmethod
+    def has_lower_bound(time_query: Dict) -> bool:
+        return any(isinstance(condition, dict) and ('$gte' in condition or '$gt' in condition)
+                   for condition in time_query.values())
+
+    def fetch_nearest(self, collection_name: str, query: Dict, projection=None,
+                      sort: List[Tuple[str, int]] = None, limit: int = 0) -> List[Dict]:
+        # The `limit` documents closest to now: upcoming ones in sort order, then the latest past ones
+        if not limit:
+            return self.fetch_serialized(collection_name, query, projection, sort)
+        field = sort[0][0]
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        documents = self.fetch_serialized(
+            collection_name, {'$and': [query, {field: {'$gte': now}}]}, projection, sort, limit)
+        if len(documents) < limit:
+            documents += self.fetch_serialized(
+                collection_name, {'$and': [query, {field: {'$lt': now}}]}, projection,
+                [(field, DESCENDING)], limit - len(documents))
+        return documents
+
+    def fetch_serialized(self, collection_name: str, query: Dict, projection=None,
+                         sort: List[Tuple[str, int]] = None, limit: int = 0) -> List[Dict]:
+        # Serialize while the cursor streams, so each document is copied exactly once
+        documents = [self.serialize_document(doc)
+                     for doc in self.db.iter_query(collection_name, query, projection, sort, limit)]
+        if limit and len(documents) == limit:
+            logger.info(f"Query on {collection_name} truncated to the first {limit} documents")
+        return documents
+
     def serialize_document(self, doc):
         if isinstance(doc, list):
             return [self.serialize_document(item) for item in doc]
@@ -800,9 +2393,8 @@ class QueryProcessor:
             return doc
 
     def extract_event_information(self, natural_query: str, user_name: str) -> Dict:
-        schedule = self.nl_to_time_schedule_event(natural_query)
-        start_time = schedule.get('Start Time')
-        end_time = schedule.get('End Time')
+        # Time resolution and field extraction are independent, so run them side by side
+        schedule_future = self.openai_service.executor.submit(self.nl_to_time_schedule_event, natural_query)
         
         prompt = f"""
         Your task is to read the provided sentence and extract the following details:
@@ -833,6 +2425,10 @@ class QueryProcessor:
         
         response = self.openai_service.create_chat_completion(prompt, system_content)
         response = response.strip()
+
+        schedule = schedule_future.result()
+        start_time = schedule.get('Start Time')
+        end_time = schedule.get('End Time')
         
         # Extract JSON using regex
         json_match = re.search(r'\{.*\}', response, re.DOTALL)
@@ -852,8 +2448,7 @@ class QueryProcessor:
             return None
 
     def extract_task_information(self, natural_query: str, user_name: str) -> Dict:
-        schedule = self.nl_to_time_schedule_task(natural_query)
-        due_date = schedule.get('Due Date')
+        schedule_future = self.openai_service.executor.submit(self.nl_to_time_schedule_task, natural_query)
         
         prompt = f"""
         Your task is to read the provided sentence and extract the following details:
@@ -890,6 +2485,9 @@ class QueryProcessor:
         response = self.openai_service.create_chat_completion(prompt, system_content)
         response = response.strip()
 
+        schedule = schedule_future.result()
+        due_date = schedule.get('Due Date')
+
         # Extract JSON using regex
         json_match = re.search(r'\{.*\}', response, re.DOTALL)
         if json_match:
@@ -907,76 +2505,287 @@ class QueryProcessor:
             logger.error(f"Error decoding JSON: {e}")
             return None
 
+    def extract_structured(self, natural_query: str, user_name: str) -> Dict:
+        # Single-call alternative to categorize_input, categorize_event_task, the schedule functions and
+        # extract_*_information. Returns {'action', 'event_task', 'document'}; 'document' is None when the
+        # reply fails local validation, and the whole result is None when the call itself fails, so the
+        # caller can fall back to the step-by-step path.
+        now = datetime.now()
+        prompt = f"""
+        Current time: {now.strftime('%Y-%m-%d %H:%M:%S')} ({now.strftime('%A')})
+
+        Read the message and fill in every field.
+
+        intent: Query (asks about existing events or tasks), Schedule (creates a new event or task), Update (changes an existing one), Delete (removes an existing one) or Conversation (anything else, including general questions).
+
+        Fill the remaining fields only when intent is Schedule, otherwise return them as null:
+        event_task: Event if the message has a specific time or involves meetings, appointments or scheduling; Task if it has a duration or a deadline. Meetings and appointments are always events.
+        title: the main subject without words like Book or Schedule, including participant names. "Book an appointment with Eddie" is "Appointment with Eddie".
+        description: one concise sentence, longer than the title.
+        location: the city or country, or null.
+        participants: Event only, the people involved including {user_name}, or null.
+        start_time, end_time: Event only, "yyyy-mm-dd HH:MM:SS". Without an end time use the default duration: meetings 60 minutes, coffee/lunch 30, interviews 45, workshops/training 120, quick catch-ups 15, doctor appointments 30, gym/workout 90.
+        due_date: Task only, "yyyy-mm-dd HH:MM:SS". "By end of day" is 23:59:59 today, "by tomorrow" 23:59:59 tomorrow, "by this week" 23:59:59 Sunday, "by next week" 23:59:59 next Sunday, "by this month" 23:59:59 on the last day of the month. A date without a time is due at 23:59:59 that day.
+        priority: Task only, High, Medium or Low from urgency words and context, Medium if unclear.
+        duration_minutes: Task only, the stated duration, else an estimate: 30 for simple, 60 for medium, 120 for complex tasks.
+        tags: Task only, relevant tags, or null.
+
+        Times of day: early morning 07:00, morning 09:00, late morning 11:00, noon 12:00, early afternoon 13:00, afternoon 14:00, late afternoon 16:00, early evening 17:00, evening 18:00, night 20:00, late night 22:00.
+        Days: "beginning of week" is Monday, "mid-week" Wednesday, "end of week" Friday.
+
+        Message: "{natural_query}"
+        """
+        system_content = "You are an AI assistant that categorizes scheduling requests and extracts their details into a structured format."
+
+        try:
+            extraction = self.openai_service.create_structured_completion(
+                prompt, system_content, self.EXTRACTION_SCHEMA, "schedule_request")
+        except (RuntimeError, json.JSONDecodeError) as e:
+            logger.warning(f"Combined extraction failed, falling back to step-by-step extraction: {str(e)}")
+            return None
+
+        result = {'action': extraction['intent'], 'event_task': None, 'document': None}
+        if result['action'] != 'Schedule' or extraction['event_task'] not in ('Event', 'Task'):
+            return result
+        result['event_task'] = extraction['event_task']
+        try:
+            if result['event_task'] == 'Event':
+                result['document'] = self.structured_event(natural_query, user_name, extraction, now)
+            else:
+                result['document'] = self.structured_task(natural_query, user_name, extraction, now)
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            logger.warning(f"Combined extraction rejected, re-extracting the {result['event_task'].lower()}: {str(e)}")
+        return result
+
+    def structured_event(self, natural_query: str, user_name: str, extraction: Dict, now: datetime) -> Dict:
+        # Locally resolvable times win over the model's, so both extraction paths agree on them
+        schedule = self.time_parser.parse_event_schedule(natural_query, now) or {
+            'Start Time': extraction['start_time'], 'End Time': extraction['end_time']}
+        start_time = datetime.strptime(schedule['Start Time'], '%Y-%m-%d %H:%M:%S')
+        end_time = datetime.strptime(schedule['End Time'], '%Y-%m-%d %H:%M:%S')
+        if start_time >= end_time:
+            raise ValueError("End time must be after start time")
+        if (end_time - start_time).total_seconds() < 300:
+            raise ValueError("Event duration must be at least 5 minutes")
+        if not extraction['title']:
+            raise ValueError("Missing title")
+
+        return {
+            "User": user_name,
+            "Source": "Conversation",
+            "Title": extraction['title'].title(),
+            "Start Time": schedule['Start Time'],
+            "End Time": schedule['End Time'],
+            "Participants": extraction['participants'],
+            "Description": extraction['description'],
+            "Location": extraction['location'],
+            "Parent": None
+        }
+
+    def structured_task(self, natural_query: str, user_name: str, extraction: Dict, now: datetime) -> Dict:
+        schedule = self.time_parser.parse_task_schedule(natural_query, now) or {'Due Date': extraction['due_date']}
+        if datetime.strptime(schedule['Due Date'], '%Y-%m-%d %H:%M:%S') < now:
+            raise ValueError("Due date must be in the future")
+        if not extraction['title']:
+            raise ValueError("Missing title")
+        if not extraction['duration_minutes'] or extraction['duration_minutes'] <= 0:
+            raise ValueError("Missing duration")
+
+        return {
+            "User": user_name,
+            "Source": "User Input",
+            "Title": extraction['title'].title(),
+            "Parent": None,
+            "Due Date": schedule['Due Date'],
+            "Priority": extraction['priority'] or "Medium",
+            "Duration": f"{extraction['duration_minutes']} minutes",
+            "Tags": extraction['tags'],
+            "Subtasks": None,
+            "Location": extraction['location']
+        }
+
+
+class BusyIntervalIndex:
+    # Busy time kept as disjoint, sorted intervals that already include the buffer around each
+    # entry, so overlapping events collapse into one block and lookups are a bisect away.
+    def __init__(self, buffer: timedelta = timedelta(minutes=15)):
+        self.buffer = buffer
+        self._starts = []
+        self._ends = []
+
+    def __len__(self):
+        return len(self._starts)
+
+    def add(self, start, end):
+        start, end = start - self.buffer, end + self.buffer
+        # Intervals i..j-1 overlap or touch the new one and are merged into it
+        i = bisect.bisect_left(self._ends, start)
+        j = bisect.bisect_right(self._starts, end)
+        if i < j:
+            start = min(start, self._starts[i])
+            end = max(end, self._ends[j - 1])
+        self._starts[i:j] = [start]
+        self._ends[i:j] = [end]
+
+    def find_slot(self, start_time, duration):
+        # Earliest start at or after start_time whose whole duration avoids every busy block
+        k = bisect.bisect_right(self._starts, start_time) - 1
+        if k >= 0 and start_time < self._ends[k]:
+            start_time = self._ends[k]
+        k += 1
+        while k < len(self._starts) and start_time + duration > self._starts[k]:
+            start_time = self._ends[k]
+            k += 1
+        return start_time, start_time + duration
+
+
+class OccupancyGrid:
+    # Minute-resolution occupancy bitmap with the same add/find_slot interface as
+    # BusyIntervalIndex. Gaps are found with vectorized run lengths: _next_busy[i] is the first
+    # busy minute at or after i, so the free run starting at i is _next_busy[i] - i. Placements
+    # match the interval index whenever event times fall on whole minutes.
+    SEARCH_CHUNK = 7 * 24 * 60
+
+    def __init__(self, origin, busy, buffer: timedelta = timedelta(minutes=15)):
+        self.origin = origin
+        self.buffer = buffer
+        self._busy = busy
+        self._next_busy = self._compute_next_busy(busy)
+
+    @classmethod
+    def from_intervals(cls, starts, ends, origin, buffer: timedelta = timedelta(minutes=15)):
+        origin = pd.Timestamp(origin).floor('min')
+        starts = pd.to_datetime(pd.Series(starts)).reset_index(drop=True)
+        ends = pd.to_datetime(pd.Series(ends)).reset_index(drop=True)
+        valid = (starts.notna() & ends.notna()).to_numpy()
+        lo = np.floor((starts[valid] - buffer - origin) / pd.Timedelta(minutes=1)).to_numpy().astype(np.int64)
+        hi = np.ceil((ends[valid] + buffer - origin) / pd.Timedelta(minutes=1)).to_numpy().astype(np.int64)
+        lo = np.maximum(lo, 0)
+        keep = hi > lo
+        lo, hi = lo[keep], hi[keep]
+        size = int(hi.max()) if len(hi) else 1
+        # Rasterize every interval at once with a difference array
+        diff = np.zeros(size + 1, dtype=np.int32)
+        np.add.at(diff, lo, 1)
+        np.add.at(diff, hi, -1)
+        return cls(origin, np.cumsum(diff[:size]) > 0, buffer)
+
+    @staticmethod
+    def _compute_next_busy(busy):
+        size = len(busy)
+        positions = np.where(busy, np.arange(size), size)
+        return np.minimum.accumulate(positions[::-1])[::-1].astype(np.int64)
+
+    def __len__(self):
+        return int(self._busy.sum())
+
+    def _offset(self, ts, rounding) -> int:
+        return int(rounding((pd.Timestamp(ts) - self.origin) / pd.Timedelta(minutes=1)))
+
+    def _at(self, offset: int):
+        return self.origin + pd.Timedelta(minutes=offset)
+
+    def _grow(self, size: int):
+        old_size = len(self._busy)
+        if size <= old_size:
+            return
+        # Minutes past the old end were free, so "no busy minute ahead" now points at the new end
+        self._next_busy[self._next_busy == old_size] = size
+        self._busy = np.concatenate([self._busy, np.zeros(size - old_size, dtype=bool)])
+        self._next_busy = np.concatenate([self._next_busy, np.full(size - old_size, size, dtype=np.int64)])
+
+    def add(self, start, end):
+        lo = max(self._offset(start - self.buffer, math.floor), 0)
+        hi = self._offset(end + self.buffer, math.ceil)
+        if hi <= lo:
+            return
+        self._grow(hi)
+        self._busy[lo:hi] = True
+        self._next_busy[lo:hi] = np.arange(lo, hi)
+        # _next_busy is non-decreasing, so only the free run right before lo needs to point at it
+        first = int(np.searchsorted(self._next_busy[:lo], lo, side='right'))
+        self._next_busy[first:lo] = lo
+
+    def find_slot(self, start_time, duration):
+        size = len(self._busy)
+        needed = math.ceil(pd.Timedelta(duration) / pd.Timedelta(minutes=1))
+        offset = max(self._offset(start_time, math.ceil), 0)
+        while offset < size:
+            stop = min(offset + self.SEARCH_CHUNK, size)
+            next_busy = self._next_busy[offset:stop]
+            fits = (next_busy - np.arange(offset, stop) >= needed) | (next_busy == size)
+            if fits.any():
+                offset += int(np.argmax(fits))
+                break
+            offset = stop
+        slot_start = self._at(offset)
+        return slot_start, slot_start + duration
+
 
 class TaskScheduler:
-    def __init__(self, db: Database, openai_service: OpenAIService):
+    # Number of tasks packed into a single scoring request
+    SCORING_BATCH_SIZE = 20
+    # Fields each read needs; everything else (notably key_embedding) stays on the server
+    SCORING_FIELDS = ['Title', 'Description', 'Due Date', 'Duration', 'Priority', 'Importance', 'Value']
+    PREFERENCE_PROJECTION = {'key_embedding': 0, 'user_key': 0, 'User': 0}
+    URGENCY_FIELDS = ['Due Date', 'Duration']
+    SCHEDULE_EVENT_FIELDS = ['Start Time', 'End Time']
+    # Moved tasks are synced to Google Calendar, so keep what the calendar body and diff need
+    SCHEDULE_TASK_FIELDS = ['Title', 'Description', 'Location', 'Start Time', 'End Time', 'Due Date',
+                            'Duration', 'Priority', 'Importance', 'Value', 'Urgency',
+                            'google_event_id', 'google_sync_hash']
+
+    SCHEDULING_ENGINES = ('interval', 'bitmap')
+
+    def __init__(self, db: Database, openai_service: OpenAIService, engine: str = 'interval', cross_check: bool = False):
+        if engine not in self.SCHEDULING_ENGINES:
+            raise ValueError(f"Unknown scheduling engine: {engine}")
         self.db = db
         self.openai_service = openai_service
+        self.engine = engine
+        # Run the other engine as well and log any placement that differs
+        self.cross_check = cross_check
 
     def calculate_task_metrics(self, user_name: str):
         try:
-            user_query = {"User": {"$regex": f"\\b{re.escape(user_name)}\\b", "$options": "i"}}
-            user_tasks = self.db.execute_query('tasks', user_query)
-            user_preference = self.db.execute_query('user_preference', user_query)
+            user_query = {"user_key": normalize_user_key(user_name)}
+            user_tasks = [self.serialize_document(task) for task in self.db.iter_query(
+                'tasks', user_query, self.SCORING_FIELDS, [('Due Date', ASCENDING)])]
 
             if not user_tasks:
                 return
 
-            user_tasks = sorted([{k: v for k, v in d.items() if k != 'key_embedding'}
-                               for d in user_tasks], key=lambda x: x.get('Due Date'))
-
-            user_tasks = self.serialize_document(user_tasks)
-            user_preference = self.serialize_document(user_preference)
+            user_preference = [self.serialize_document(preference) for preference in self.db.iter_query(
+                'user_preference', user_query, self.PREFERENCE_PROJECTION)]
 
             update_operations = []
+            unscored_tasks = [task for task in user_tasks
+                              if "Importance" not in task.keys() or "Value" not in task.keys()]
+
+            batches = [unscored_tasks[i:i + self.SCORING_BATCH_SIZE]
+                       for i in range(0, len(unscored_tasks), self.SCORING_BATCH_SIZE)]
+            scores_by_id = {}
+            for batch_scores in self.openai_service.map_concurrently(
+                    lambda batch: self.score_tasks_batch(batch, user_preference), batches):
+                scores_by_id.update(batch_scores)
+
+            # Fall back to scoring tasks on their own when the batch answer was unusable
+            failed_tasks = [task for task in unscored_tasks if task["_id"] not in scores_by_id]
+            for task, scores in zip(failed_tasks, self.openai_service.map_concurrently(
+                    lambda task: self.score_task(task, user_preference), failed_tasks)):
+                scores_by_id[task["_id"]] = scores
+
+            for task in unscored_tasks:
+                scores = scores_by_id[task["_id"]]
+                task["Importance"] = scores["Importance"]
+                task["Value"] = scores["Value"]
 
-            for task in user_tasks:
-                if "Importance" not in task.keys() or "Value" not in task.keys():
-                    prompt = f"""
-                    You are an AI assistant specializing in task analysis. Your goal is to calculate both the importance and value scores for each task based on the user's preferences. On a scale of 1 to 10 for each metric:
-
-                    Importance is determined by:
-                    1. Does the task align with user's goals?
-                    2. Will not completing the task negatively affect the user?
-
-                    Value is determined by:
-                    1. What is the task's return on investment (ROI)?
-                    2. Does this task support any long term goals?
-
-                    User Preferences:
-                    {json.dumps(user_preference, indent=2)}
-
-                    Task Details:
-                    {json.dumps(task, indent=2)}
-
-                    Output:
-                    A JSON object with two integer values representing the importance and value scores of the task, like this:
-                    {{"Importance": 7, "Value": 8}}
-
-                    Note:
-                    Just return the JSON object, nothing else.
-                    """
-                    system_content = "You are an AI assistant specializing in task analysis and prioritization."
-                    task_scores = self.openai_service.create_chat_completion(prompt, system_content).strip()
-
-                    try:
-                        # Use regex to find the JSON object
-                        json_match = re.search(r'\{.*\}', task_scores, re.DOTALL)
-                        if json_match:
-                            task_scores = json_match.group()
-                        scores = json.loads(task_scores)
-                        task["Importance"] = scores.get("Importance", 0)
-                        task["Value"] = scores.get("Value", 0)
-                    except json.JSONDecodeError:
-                        logger.error(f"Failed to parse JSON response: {task_scores}")
-                        task["Importance"] = task["Value"] = 0
-
-                    update_operations.append(
-                        UpdateOne(
-                            {"_id": ObjectId(task["_id"])},
-                            {"$set": {"Importance": task["Importance"], "Value": task["Value"]}}
-                        )
+                update_operations.append(
+                    UpdateOne(
+                        {"_id": ObjectId(task["_id"])},
+                        {"$set": {"Importance": task["Importance"], "Value": task["Value"]}}
                     )
+                )
 
             if update_operations:
                 try:
@@ -987,41 +2796,128 @@ class TaskScheduler:
         except Exception as e:
             logger.error(f"An error occurred during task metrics calculation: {str(e)}")
 
-    def calculate_task_urgency(self, user_name: str):
-        now = datetime.now()
-        now_str = now.strftime('%Y-%m-%d %H:%M:%S')
+    @staticmethod
+    def _valid_scores(scores) -> bool:
+        return isinstance(scores, dict) and all(
+            isinstance(scores.get(key), (int, float)) and not isinstance(scores.get(key), bool)
+            and 0 <= scores[key] <= 10
+            for key in ("Importance", "Value"))
+
+    def score_tasks_batch(self, tasks: List[Dict], user_preference: List[Dict]) -> Dict:
+        if not tasks:
+            return {}
+        tasks_payload = {task["_id"]: {k: v for k, v in task.items() if k != "_id"} for task in tasks}
+        prompt = f"""
+        You are an AI assistant specializing in task analysis. Your goal is to calculate both the importance and value scores for each task based on the user's preferences. On a scale of 1 to 10 for each metric:
 
+        Importance is determined by:
+        1. Does the task align with user's goals?
+        2. Will not completing the task negatively affect the user?
+
+        Value is determined by:
+        1. What is the task's return on investment (ROI)?
+        2. Does this task support any long term goals?
+
+        User Preferences:
+        {json.dumps(user_preference, indent=2)}
+
+        Tasks (keyed by task id):
+        {json.dumps(tasks_payload, indent=2)}
+
+        Output:
+        A JSON object keyed by every task id above, each with two integer values representing the importance and value scores of that task, like this:
+        {{"<task id>": {{"Importance": 7, "Value": 8}}}}
+
+        Note:
+        Just return the JSON object, nothing else.
+        """
+        system_content = "You are an AI assistant specializing in task analysis and prioritization."
         try:
-            user_query = {"User": {"$regex": f"\\b{re.escape(user_name)}\\b", "$options": "i"}}
-            user_tasks = self.db.execute_query('tasks', user_query)
+            response = self.openai_service.create_chat_completion(prompt, system_content).strip()
+        except RuntimeError as e:
+            logger.error(f"Batch task scoring failed: {str(e)}")
+            return {}
 
-            if not user_tasks:
-                return
+        json_match = re.search(r'\{.*\}', response, re.DOTALL)
+        try:
+            scores_by_id = json.loads(json_match.group() if json_match else response)
+        except json.JSONDecodeError:
+            logger.error(f"Failed to parse batch scoring response: {response}")
+            return {}
+        if not isinstance(scores_by_id, dict):
+            return {}
+
+        valid_scores = {}
+        for task_id in tasks_payload:
+            scores = scores_by_id.get(task_id)
+            if self._valid_scores(scores):
+                valid_scores[task_id] = {"Importance": scores["Importance"], "Value": scores["Value"]}
+            else:
+                logger.warning(f"Batch scoring returned no usable scores for task {task_id}")
+        return valid_scores
 
-            user_tasks = sorted([{k: v for k, v in d.items() if k != 'key_embedding'}
-                               for d in user_tasks], key=lambda x: x.get('Due Date'))
+    def score_task(self, task: Dict, user_preference: List[Dict]) -> Dict:
+        prompt = f"""
+        You are an AI assistant specializing in task analysis. Your goal is to calculate both the importance and value scores for each task based on the user's preferences. On a scale of 1 to 10 for each metric:
 
+        Importance is determined by:
+        1. Does the task align with user's goals?
+        2. Will not completing the task negatively affect the user?
 
-            user_tasks = self.serialize_document(user_tasks)
-            update_operations = []
+        Value is determined by:
+        1. What is the task's return on investment (ROI)?
+        2. Does this task support any long term goals?
 
-            for task in user_tasks:
-                task['Query Time'] = now_str
-                due_date = datetime.strptime(task['Due Date'], '%Y-%m-%d %H:%M:%S')
-                time_diff = (due_date - now).total_seconds()
-                duration = int(re.search(r'\d+', task['Duration']).group()) * 60
+        User Preferences:
+        {json.dumps(user_preference, indent=2)}
 
-                if time_diff <= duration:
-                    task["Urgency"] = 10.00
-                else:
-                    task["Urgency"] = round(duration / time_diff * 10, 4)
+        Task Details:
+        {json.dumps(task, indent=2)}
 
-                update_operations.append(
-                    UpdateOne(
-                        {"_id": ObjectId(task["_id"])},
-                        {"$set": {"Urgency": task["Urgency"]}}
-                    )
+        Output:
+        A JSON object with two integer values representing the importance and value scores of the task, like this:
+        {{"Importance": 7, "Value": 8}}
+
+        Note:
+        Just return the JSON object, nothing else.
+        """
+        system_content = "You are an AI assistant specializing in task analysis and prioritization."
+        task_scores = self.openai_service.create_chat_completion(prompt, system_content).strip()
+
+        try:
+            # Use regex to find the JSON object
+            json_match = re.search(r'\{.*\}', task_scores, re.DOTALL)
+            if json_match:
+                task_scores = json_match.group()
+            scores = json.loads(task_scores)
+            return {"Importance": scores.get("Importance", 0), "Value": scores.get("Value", 0)}
+        except json.JSONDecodeError:
+            logger.error(f"Failed to parse JSON response: {task_scores}")
+            return {"Importance": 0, "Value": 0}
+
+    @staticmethod
+    def compute_urgency(task: Dict, now: datetime) -> float:
+        due_date = datetime.strptime(task['Due Date'], '%Y-%m-%d %H:%M:%S')
+        time_diff = (due_date - now).total_seconds()
+        duration = int(re.search(r'\d+', task['Duration']).group()) * 60
+
+        if time_diff <= duration:
+            return 10.00
+        return round(duration / time_diff * 10, 4)
+
+    def calculate_task_urgency(self, user_name: str):
+        now = datetime.now()
+
+        try:
+            user_query = {"user_key": normalize_user_key(user_name)}
+            # Each task only contributes an update, so nothing but the operations is held in memory
+            update_operations = [
+                UpdateOne(
+                    {"_id": task["_id"]},
+                    {"$set": {"Urgency": self.compute_urgency(task, now)}}
                 )
+                for task in self.db.iter_query('tasks', user_query, self.URGENCY_FIELDS)
+            ]
 
 
             if update_operations:
@@ -1035,30 +2931,29 @@ class TaskScheduler:
         except Exception as e:
             logger.error(f"An error occurred during task calculations: {str(e)}")
 
-    def schedule_tasks(self, user_name: str):
-        now = datetime.now()
+    def load_schedule_inputs(self, user_name: str, now: datetime, refresh_urgency: bool = False):
         events_time_query = {"Start Time": {"$gte": now.strftime('%Y-%m-%d %H:%M:%S')}}
         tasks_time_query = {"Due Date": {"$gte": now.strftime('%Y-%m-%d %H:%M:%S')}}
 
-        events_query = {"User": {"$regex": f"\\b{re.escape(user_name)}\\b", "$options": "i"}}
+        events_query = {"user_key": normalize_user_key(user_name)}
         events_query.update(events_time_query)
         
-        tasks_query = {"User": {"$regex": f"\\b{re.escape(user_name)}\\b", "$options": "i"}}
+        tasks_query = {"user_key": normalize_user_key(user_name)}
         tasks_query.update(tasks_time_query)
 
-        events_filtered = self.db.execute_query('events', events_query)
-        tasks_filtered = self.db.execute_query('tasks', tasks_query)
+        tasks_filtered = [self.serialize_document(task) for task in self.db.iter_query(
+            'tasks', tasks_query, self.SCHEDULE_TASK_FIELDS, [('Due Date', ASCENDING)])]
 
         if not tasks_filtered:
-            return
+            return None
 
-        events_filtered = sorted([{k: v for k, v in d.items() if k != 'key_embedding'}
-                                for d in events_filtered], key=lambda x: x.get('Start Time'))
-        tasks_filtered = sorted([{k: v for k, v in d.items() if k != 'key_embedding'}
-                               for d in tasks_filtered], key=lambda x: x.get('Due Date'))
+        # Every slot ends by its task's due date, so events starting a buffer after the latest
+        # due date can never block one and are left in the database
+        horizon = datetime.strptime(tasks_filtered[-1]['Due Date'], '%Y-%m-%d %H:%M:%S') + timedelta(minutes=15)
+        events_query['Start Time']['$lt'] = horizon.strftime('%Y-%m-%d %H:%M:%S')
 
-        events_filtered = self.serialize_document(events_filtered)
-        tasks_filtered = self.serialize_document(tasks_filtered)
+        events_filtered = [self.serialize_document(event) for event in self.db.iter_query(
+            'events', events_query, self.SCHEDULE_EVENT_FIELDS, [('Start Time', ASCENDING)])]
 
         # Prepare events and tasks dataframes
         if events_filtered:
@@ -1094,6 +2989,8 @@ class TaskScheduler:
         # Calculate total score for each task
         scheduled_tasks = []
         for task in tasks_filtered:
+            if refresh_urgency:
+                task['Urgency'] = self.compute_urgency(task, now)
             task['Total Score'] = task['Importance'] * task['Value'] * task['Urgency']
             scheduled_tasks.append(task)
 
@@ -1103,76 +3000,178 @@ class TaskScheduler:
                          [task for task in scheduled_tasks if task['Priority'] == "Medium"] + \
                          [task for task in scheduled_tasks if task['Priority'] == "Low"]
 
+        return events_df, scheduled_tasks
+
+    def schedule_tasks(self, user_name: str):
+        now = datetime.now()
+        schedule_inputs = self.load_schedule_inputs(user_name, now)
+        if schedule_inputs is None:
+            return
+        events_df, scheduled_tasks = schedule_inputs
+
         update_operations = []
 
+        start_time = (now + pd.Timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+        placements = self.place_tasks(
+            self.build_busy_index(events_df, self.engine, now), scheduled_tasks, start_time)
+
+        if self.cross_check:
+            other_engine = 'bitmap' if self.engine == 'interval' else 'interval'
+            other_placements = self.place_tasks(
+                self.build_busy_index(events_df, other_engine, now), scheduled_tasks, start_time)
+            for task, placement, other_placement in zip(scheduled_tasks, placements, other_placements):
+                if placement != other_placement:
+                    logger.warning(
+                        f"Scheduling engines disagree on task {task['Title']}: "
+                        f"{self.engine}={placement}, {other_engine}={other_placement}")
+
         # Schedule tasks
-        for task in scheduled_tasks:
-            task_duration = pd.Timedelta(minutes=int(re.search(r'\d+', task['Duration']).group()))
-            due_date = pd.to_datetime(task['Due Date'])
-            start_time = (now + pd.Timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+        for task, placement in zip(scheduled_tasks, placements):
+            if placement is not None:
+                suggested_start, suggested_end = placement
+                task['Start Time'] = suggested_start.strftime('%Y-%m-%d %H:%M:%S')
+                task['End Time'] = suggested_end.strftime('%Y-%m-%d %H:%M:%S')
 
-            while True:
-                suggested_start, suggested_end = self.find_next_available_slot(
-                    events_df, start_time, task_duration)
-
-                if suggested_end <= due_date:
-                    task['Start Time'] = suggested_start.strftime('%Y-%m-%d %H:%M:%S')
-                    task['End Time'] = suggested_end.strftime('%Y-%m-%d %H:%M:%S')
-
-                    update_operations.append(
-                        UpdateOne(
-                            {"_id": ObjectId(task["_id"])},
-                            {"$set": {
-                                "Start Time": task["Start Time"],
-                                "End Time": task["End Time"]
-                            }}
-                        )
+                update_operations.append(
+                    UpdateOne(
+                        {"_id": ObjectId(task["_id"])},
+                        {"$set": {
+                            "Start Time": task["Start Time"],
+                            "End Time": task["End Time"]
+                        }}
+                    )
+                )
+            else:
+                logger.warning(
+                    f"Could not schedule task {task['Title']} before its due date.")
+                update_operations.append(
+                    UpdateOne(
+                        {"_id": ObjectId(task["_id"])},
+                        {"$set": {"Start Time": None, "End Time": None}}
                     )
+                )
 
-                    new_event = pd.DataFrame({
-                        'Start Time': [suggested_start],
-                        'End Time': [suggested_end]
-                    })
-                    events_df = pd.concat([events_df, new_event]).sort_values(
-                        'Start Time').reset_index(drop=True)
-                    break
-                else:
-                    start_time += pd.Timedelta(minutes=15)
+        if update_operations:
+            try:
+                self.db.bulk_write('tasks', update_operations)
+            except PyMongoError as e:
+                logger.error(f"Error during bulk write operation: {str(e)}")
 
-                if start_time > due_date:
-                    logger.warning(
-                        f"Could not schedule task {task['Title']} before its due date.")
-                    update_operations.append(
-                        UpdateOne(
-                            {"_id": ObjectId(task["_id"])},
-                            {"$set": {"Start Time": None, "End Time": None}}
-                        )
-                    )
-                    break
+    @staticmethod
+    def _task_slot(document: Dict):
+        if not document or not document.get('Start Time') or not document.get('End Time'):
+            return None
+        return pd.to_datetime(document['Start Time']), pd.to_datetime(document['End Time'])
+
+    def reschedule_incremental(self, user_name: str, changed_document: Dict = None,
+                               previous_document: Dict = None) -> List[Dict]:
+        # Re-place only the tasks a single change can affect and return those whose slot moved.
+        # Tasks are placed greedily in priority order, so every task ahead of the first affected
+        # one keeps its slot. A task is affected when it is the changed document, has no slot yet,
+        # starts before the scheduling horizon, collides with an event or an earlier task (such as
+        # the changed event's new time), or starts after a slot the change freed and could
+        # therefore move earlier.
+        now = datetime.now()
+        schedule_inputs = self.load_schedule_inputs(user_name, now, refresh_urgency=True)
+        if schedule_inputs is None:
+            return []
+        events_df, scheduled_tasks = schedule_inputs
+
+        buffer = timedelta(minutes=15)
+        start_time = (now + pd.Timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+        changed_id = str(changed_document['_id']) if changed_document and changed_document.get('_id') else None
+        freed = [self._task_slot(previous_document)] if self._task_slot(previous_document) else []
+        busy_index = self.build_busy_index(events_df, self.engine, now)
+
+        def is_affected(task):
+            slot = self._task_slot(task)
+            if slot is None or task['_id'] == changed_id or slot[0] < start_time:
+                return True
+            task_start, task_end = slot
+            if busy_index.find_slot(task_start, task_end - task_start)[0] != task_start:
+                return True
+            return any(task_start >= start - buffer for start, _ in freed)
+
+        first_affected = len(scheduled_tasks)
+        for i, task in enumerate(scheduled_tasks):
+            if is_affected(task):
+                first_affected = i
+                break
+            busy_index.add(*self._task_slot(task))
+        replaced_tasks = scheduled_tasks[first_affected:]
+        if not replaced_tasks:
+            return []
 
+        placements = self.place_tasks(busy_index, replaced_tasks, start_time)
+
+        update_operations = []
+        changed_tasks = []
+        for task, placement in zip(replaced_tasks, placements):
+            if placement is not None:
+                new_slot = (placement[0].strftime('%Y-%m-%d %H:%M:%S'), placement[1].strftime('%Y-%m-%d %H:%M:%S'))
+            else:
+                logger.warning(f"Could not schedule task {task['Title']} before its due date.")
+                new_slot = (None, None)
+            if (task.get('Start Time'), task.get('End Time')) == new_slot:
+                continue
+
+            task['Start Time'], task['End Time'] = new_slot
+            update_operations.append(
+                UpdateOne(
+                    {"_id": ObjectId(task["_id"])},
+                    {"$set": {
+                        "Start Time": task["Start Time"],
+                        "End Time": task["End Time"],
+                        "Urgency": task["Urgency"]
+                    }}
+                )
+            )
+            changed_tasks.append(task)
+
+        logger.info(f"Incremental reschedule re-placed {len(replaced_tasks)} of {len(scheduled_tasks)} tasks, "
+                    f"{len(changed_tasks)} moved")
         if update_operations:
             try:
                 self.db.bulk_write('tasks', update_operations)
             except PyMongoError as e:
                 logger.error(f"Error during bulk write operation: {str(e)}")
+        return changed_tasks
 
     @staticmethod
-    def find_next_available_slot(events_df, start_time, duration):
-        end_time = start_time + duration
-        for index, row in events_df.iterrows():
-            if start_time >= row['End Time'] + pd.Timedelta(minutes=15):
-                if index == len(events_df) - 1 or end_time <= events_df.iloc[index + 1]['Start Time'] - pd.Timedelta(minutes=15):
-                    return start_time, end_time
-            elif start_time < row['Start Time'] - pd.Timedelta(minutes=15):
-                if end_time <= row['Start Time'] - pd.Timedelta(minutes=15):
-                    return start_time, end_time
-                else:
-                    start_time = row['End Time'] + pd.Timedelta(minutes=15)
-                    end_time = start_time + duration
+    def place_tasks(busy_index, tasks: List[Dict], start_time) -> List:
+        # Greedily give each task, in priority order, the earliest free slot before its due date
+        placements = []
+        for task in tasks:
+            task_duration = pd.Timedelta(minutes=int(re.search(r'\d+', task['Duration']).group()))
+            due_date = pd.to_datetime(task['Due Date'])
+
+            # The index returns the earliest free slot, so a slot ending after the due date means none fits
+            suggested_start, suggested_end = busy_index.find_slot(start_time, task_duration)
+            if suggested_end <= due_date:
+                busy_index.add(suggested_start, suggested_end)
+                placements.append((suggested_start, suggested_end))
             else:
-                start_time = row['End Time'] + pd.Timedelta(minutes=15)
-                end_time = start_time + duration
-        return start_time, end_time
+                placements.append(None)
+        return placements
+
+    @staticmethod
+    def build_busy_index(events_df, engine: str = 'interval', origin=None):
+        buffer = timedelta(minutes=15)
+        if engine == 'bitmap':
+            starts = pd.to_datetime(events_df['Start Time'])
+            if origin is None or (starts.notna().any() and starts.min() - buffer < origin):
+                origin = starts.min() - buffer if starts.notna().any() else pd.Timestamp.now()
+            return OccupancyGrid.from_intervals(events_df['Start Time'], events_df['End Time'], origin, buffer)
+
+        busy_index = BusyIntervalIndex(buffer)
+        for start, end in zip(events_df['Start Time'], events_df['End Time']):
+            if pd.notna(start) and pd.notna(end):
+                busy_index.add(start, end)
+        return busy_index
+
+    @staticmethod
+    def find_next_available_slot(events_df, start_time, duration):
+        return TaskScheduler.build_busy_index(events_df).find_slot(start_time, duration)
 
     def serialize_document(self, doc):
         if isinstance(doc, list):
@@ -1184,11 +3183,176 @@ class TaskScheduler:
         else:
             return doc
 
+class TextClassifier:
+    # TF-IDF over word unigrams and bigrams with a multinomial logistic regression on top, in plain
+    # NumPy. Fitting a few thousand sentences takes well under a second, and a prediction only
+    # touches the weight rows of the sentence's own n-grams.
+    TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+    def __init__(self, l2: float = 1e-4, epochs: int = 300, learning_rate: float = 5.0):
+        self.l2 = l2
+        self.epochs = epochs
+        self.learning_rate = learning_rate
+        self.labels = []
+        self.vocabulary = {}
+        self.idf = None
+        self.weights = None
+        self.bias = None
+
+    @classmethod
+    def ngrams(cls, text: str) -> List[str]:
+        tokens = cls.TOKEN_PATTERN.findall(text.lower().replace('’', "'"))
+        return tokens + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])]
+
+    def _vector(self, text: str):
+        # (indices, values) of the l2-normalized, sublinear tf-idf vector
+        counts = {}
+        for gram in self.ngrams(text):
+            index = self.vocabulary.get(gram)
+            if index is not None:
+                counts[index] = counts.get(index, 0) + 1
+        indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = (1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))) * self.idf[indices]
+        norm = np.linalg.norm(values)
+        return indices, values / norm if norm else values
+
+    def fit(self, texts: List[str], labels: List[str]):
+        self.labels = sorted(set(labels))
+        document_frequency = {}
+        for text in texts:
+            for gram in set(self.ngrams(text)):
+                document_frequency[gram] = document_frequency.get(gram, 0) + 1
+        self.vocabulary = {gram: index for index, gram in enumerate(document_frequency)}
+        frequencies = np.fromiter(document_frequency.values(), dtype=np.float32, count=len(document_frequency))
+        self.idf = np.log((1 + len(texts)) / (1 + frequencies)) + 1
+
+        features = np.zeros((len(texts), len(self.vocabulary)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            indices, values = self._vector(text)
+            features[row, indices] = values
+        targets = np.zeros((len(texts), len(self.labels)), dtype=np.float32)
+        targets[np.arange(len(texts)), [self.labels.index(label) for label in labels]] = 1
+
+        # Full-batch gradient descent on the L2-regularized cross-entropy
+        self.weights = np.zeros((len(self.vocabulary), len(self.labels)), dtype=np.float32)
+        self.bias = np.zeros(len(self.labels), dtype=np.float32)
+        for _ in range(self.epochs):
+            gradient = (self._softmax(features @ self.weights + self.bias) - targets) / len(texts)
+            self.weights -= self.learning_rate * (features.T @ gradient + self.l2 * self.weights)
+            self.bias -= self.learning_rate * gradient.sum(axis=0)
+        return self
+
+    @staticmethod
+    def _softmax(logits):
+        exponentials = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        return exponentials / exponentials.sum(axis=-1, keepdims=True)
+
+    def predict_proba(self, text: str) -> Dict[str, float]:
+        indices, values = self._vector(text)
+        probabilities = self._softmax(self.bias + values @ self.weights[indices])
+        return dict(zip(self.labels, probabilities.tolist()))
+
+class IntentClassifier:
+    # Local first stage of the Categorizer. Keyword rules catch the usual command shapes and a
+    # TextClassifier fit on the labelled sentences of the CRUD evaluation sheet scores the rest.
+    # Every answer carries a confidence; the Categorizer only asks the LLM when it is too low.
+    # Category names used in the evaluation sheet
+    SHEET_LABELS = {'Read': 'Query', 'Create': 'Schedule', 'Update': 'Update', 'Delete': 'Delete',
+                    'Conversation': 'Conversation', 'General Conversation': 'Conversation'}
+    RULE_CONFIDENCE = 0.95
+    LEAD = (r"^(?:(?:hey|hi|ok|okay|please|can you|could you|would you|will you|i need to|i want to|"
+            r"i'd like to|i would like to|help me|go ahead and)\W+)*")
+    # A command rule needs a calendar item or a time somewhere in the text and an object after the
+    # verb, so figures of speech such as "clear my head" are left to the model and the LLM
+    COMMAND = (r"^(?=.*\b(?:meetings?|events?|tasks?|appointments?|calls?|reminders?|deadlines?|interviews?|"
+               r"sessions?|class(?:es)?|flights?|lunch|dinner|breakfast|calendar|schedule|today|tonight|tomorrow|"
+               r"(?:mon|tues|wednes|thurs|fri|satur|sun)days?|week|weekend|month|morning|afternoon|evening|"
+               r"noon|\d{1,2}(?::\d{2})?\s*(?:am|pm))\b)")
+    OBJECT = r"\s+\w"
+    INTENT_RULES = [
+        ('Delete', re.compile(COMMAND + LEAD + r"(?:cancel|delete|remove|drop|clear|erase)\b" + OBJECT)),
+        ('Update', re.compile(COMMAND + LEAD + r"(?:move|reschedule|change|update|shift|extend|shorten|postpone|push|rename|modify)\b" + OBJECT)),
+        ('Schedule', re.compile(COMMAND + LEAD + r"(?:schedule|book|create|set up|remind me|plan|block|add\b(?!.*\bto (?:the|my)\b))\b" + OBJECT)),
+        ('Query', re.compile(r"^(?:what|when|where|which|show|list|do i|am i|is there|are there|how many|how long|check)\b"
+                             r"(?=.*\b(?:my|i|me)\b)(?=.*\b(?:schedule|calendar|meetings?|events?|tasks?|appointments?|free|busy|"
+                             r"available|availability|deadlines?|due|planned|agenda)\b)")),
+    ]
+    # (pattern, label, confidence) in priority order; meetings and appointments are always events
+    EVENT_TASK_RULES = [
+        (re.compile(r"\b(?:meetings?|appointments?|calls?|interviews?|flights?|lunch|dinner|breakfast|consultation|conference)\b"),
+         'Event', 0.95),
+        (re.compile(r"\b(?:due|deadlines?|by (?:the )?end of)\b"), 'Task', 0.95),
+        (re.compile(r"\b\d{1,2}(?::\d{2})?\s*(?:am|pm)\b|\bat \d{1,2}\b|\bnoon\b"), 'Event', 0.8),
+        (re.compile(r"\b\d+\s*(?:minutes?|mins?|hours?|hrs?)\b"), 'Task', 0.8),
+    ]
+
+    def __init__(self, training_path: str = None):
+        self.model = None
+        if training_path:
+            try:
+                texts, labels = self.load_examples(training_path)
+                started = time.perf_counter()
+                self.model = TextClassifier().fit(texts, labels)
+                logger.info(f"Fit intent model on {len(texts)} examples in {time.perf_counter() - started:.2f}s")
+            except Exception as e:
+                logger.warning(f"Intent model unavailable, using keyword rules only: {str(e)}")
+
+    @classmethod
+    def load_examples(cls, path: str) -> Tuple[List[str], List[str]]:
+        df = pd.read_excel(path, index_col=0)
+        df = df[['Natural Language Query', 'Category']].dropna()
+        labels = df['Category'].astype(str).str.strip().map(cls.SHEET_LABELS)
+        df = df[labels.notna()]
+        return [cls.normalize(text) for text in df['Natural Language Query']], list(labels.dropna())
+
+    @staticmethod
+    def normalize(text) -> str:
+        return ' '.join(str(text).replace('’', "'").split()).strip(' "“”').lower()
+
+    def classify_intent(self, natural_query: str) -> Tuple[str, float]:
+        text = self.normalize(natural_query)
+        rule = next((label for label, pattern in self.INTENT_RULES if pattern.search(text)), None)
+        if self.model is None:
+            return (rule, self.RULE_CONFIDENCE) if rule else (None, 0.0)
+        probabilities = self.model.predict_proba(text)
+        label = max(probabilities, key=probabilities.get)
+        if rule is None:
+            return label, probabilities[label]
+        if rule == label:
+            return rule, max(self.RULE_CONFIDENCE, probabilities[label])
+        # The model disagrees with the rule, so the rule only keeps the model's own confidence
+        return rule, probabilities.get(rule, 0.0)
+
+    def classify_event_task(self, natural_query: str) -> Tuple[str, float]:
+        text = self.normalize(natural_query)
+        for pattern, label, confidence in self.EVENT_TASK_RULES:
+            if pattern.search(text):
+                return label, confidence
+        return None, 0.0
+
 class Categorizer:
-    def __init__(self, openai_service: OpenAIService):
+    def __init__(self, openai_service: OpenAIService, classifier: IntentClassifier = None,
+                 intent_threshold: float = 0.9, event_task_threshold: float = 0.9):
         self.openai_service = openai_service
+        # Local answers at or above these confidences skip the LLM; a threshold above 1 disables them
+        self.classifier = classifier
+        self.intent_threshold = intent_threshold
+        self.event_task_threshold = event_task_threshold
+
+    def categorize_locally(self, natural_query: str) -> str:
+        # The classifier's answer when it is confident enough, otherwise None
+        if self.classifier is not None:
+            label, confidence = self.classifier.classify_intent(natural_query)
+            if label is not None and confidence >= self.intent_threshold:
+                logger.info(f"Categorized input locally as {label} ({confidence:.2f})")
+                return label
+        return None
 
     def categorize_input(self, natural_query: str) -> str:
+        label = self.categorize_locally(natural_query)
+        if label is not None:
+            return label
+
         prompt = f"""
         You are an AI assistant specializing in categorizing sentences into five distinct categories: Query, Schedule, Update, Delete, and Conversation.
 
@@ -1270,6 +3434,12 @@ class Categorizer:
             return "Invalid"
 
     def categorize_event_task(self, natural_query: str) -> str:
+        if self.classifier is not None:
+            label, confidence = self.classifier.classify_event_task(natural_query)
+            if label is not None and confidence >= self.event_task_threshold:
+                logger.info(f"Categorized schedule request locally as {label} ({confidence:.2f})")
+                return label
+
         prompt = f"""
         Categorize the following sentence as either 'Event' or 'Task' based on these criteria:
 
@@ -1317,17 +3487,88 @@ class Categorizer:
 class TaskGenieApp:
     def __init__(self):
         load_dotenv()
-        self.db = Database(os.getenv('MONGODB_URI'))
+        self.db = Database(
+            os.getenv('MONGODB_URI'),
+            max_pool_size=int(os.getenv('MONGODB_MAX_POOL_SIZE', 50)),
+            min_pool_size=int(os.getenv('MONGODB_MIN_POOL_SIZE', 0)),
+            health_check_interval=float(os.getenv('MONGODB_HEALTH_CHECK_INTERVAL', 30)),
+            vector_backend=os.getenv('VECTOR_BACKEND', 'atlas'),
+            vector_partitions=int(os.getenv('VECTOR_PARTITIONS', 0)),
+            batch_size=int(os.getenv('MONGODB_BATCH_SIZE', 200))
+        )
         # self.openai_service = OpenAIService(os.getenv('AZURE_OPENAI_ENDPOINT'), os.getenv('AZURE_OPENAI_API_KEY'), "2024-02-01")
-        self.openai_service = OpenAIService(os.getenv('OPENAI_API_KEY'))
-        self.query_processor = QueryProcessor(self.db, self.openai_service)
-        self.task_scheduler = TaskScheduler(self.db, self.openai_service)
-        self.categorizer = Categorizer(self.openai_service)
+        self.openai_service = OpenAIService(
+            os.getenv('OPENAI_API_KEY'),
+            EmbeddingCache(
+                max_size=int(os.getenv('EMBEDDING_CACHE_SIZE', 1024)),
+                path=os.getenv('EMBEDDING_CACHE_PATH')
+            ),
+            RateLimiter(
+                requests_per_minute=int(os.getenv('LLM_REQUESTS_PER_MINUTE', 500)),
+                tokens_per_minute=int(os.getenv('LLM_TOKENS_PER_MINUTE', 200000))
+            ),
+            max_workers=int(os.getenv('LLM_MAX_WORKERS', 8))
+        )
+        self.embedding_pipeline = EmbeddingPipeline(
+            self.db,
+            self.openai_service,
+            batch_size=int(os.getenv('EMBEDDING_BATCH_SIZE', 64)),
+            flush_interval=float(os.getenv('EMBEDDING_FLUSH_INTERVAL', 1.0))
+        )
+        self.db.embedding_pipeline = self.embedding_pipeline
+        self.query_processor = QueryProcessor(
+            self.db,
+            self.openai_service,
+            CompiledFunctionCache(
+                max_size=int(os.getenv('TIME_QUERY_CACHE_SIZE', 256)),
+                path=os.getenv('TIME_QUERY_CACHE_PATH')
+            ),
+            result_limit=int(os.getenv('QUERY_RESULT_LIMIT', 50)),
+            context_packer=ContextPacker(
+                max_tokens=int(os.getenv('FILTER_CONTEXT_TOKENS', 4000)),
+                model=self.openai_service.CHAT_MODEL
+            ),
+            response_cache=ResponseCache(
+                max_size=int(os.getenv('RESPONSE_CACHE_SIZE', 512)),
+                ttl=float(os.getenv('RESPONSE_CACHE_TTL', 900))
+            )
+        )
+        self.task_scheduler = TaskScheduler(
+            self.db,
+            self.openai_service,
+            engine=os.getenv('SCHEDULER_ENGINE', 'interval'),
+            cross_check=os.getenv('SCHEDULER_CROSS_CHECK', '').lower() in ('1', 'true', 'yes')
+        )
+        self.categorizer = Categorizer(
+            self.openai_service,
+            IntentClassifier(os.getenv(
+                'INTENT_TRAINING_PATH',
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TaskGenie CRUD Evaluation.xlsx')
+            )),
+            intent_threshold=float(os.getenv('INTENT_CONFIDENCE_THRESHOLD', 0.9)),
+            event_task_threshold=float(os.getenv('EVENT_TASK_CONFIDENCE_THRESHOLD', 0.9))
+        )
+        # 'combined' extracts Schedule requests with one structured LLM call, 'sequential' step by step
+        self.combined_extraction = os.getenv('EXTRACTION_MODE', 'combined').lower() == 'combined'
+
+    def categorize(self, user_name: str, natural_query: str) -> Tuple[str, Dict]:
+        # Returns (action, extraction); extraction is the combined extraction result when one was made.
+        # Messages the local classifier confidently places outside Schedule never reach the LLM here.
+        if self.combined_extraction:
+            action = self.categorizer.categorize_locally(natural_query)
+            if action in (None, 'Schedule'):
+                extraction = self.query_processor.extract_structured(natural_query, user_name)
+                if extraction is not None:
+                    return extraction['action'], extraction
+            if action is not None:
+                return action, None
+        return self.categorizer.categorize_input(natural_query), None
 
     async def run(self):
         print("AI Assistant: Hello! I am TaskGenie, your AI assistant. Type 'exit' to end the conversation.")
         try:
             self.db.connect()
+            self.db.prepare()
             user_name = input("AI Assistant: Please enter your name: ").strip()
             
             while True:
@@ -1335,12 +3576,12 @@ class TaskGenieApp:
                 if natural_query.lower() == 'exit':
                     break
 
-                action = self.categorizer.categorize_input(natural_query)
+                action, extraction = self.categorize(user_name, natural_query)
                 
                 if action == 'Query':
                     await self.handle_query(user_name, natural_query)
                 elif action == 'Schedule':
-                    await self.handle_schedule(user_name, natural_query)
+                    await self.handle_schedule(user_name, natural_query, extraction)
                 elif action == 'Update':
                     await self.handle_update(user_name, natural_query)
                 elif action == 'Delete':
@@ -1369,18 +3610,19 @@ class TaskGenieApp:
                 print(json.dumps(document, cls=MongoJSONEncoder))
                 print("-" * 50)
 
-    async def handle_schedule(self, user_name: str, natural_query: str):
+    async def handle_schedule(self, user_name: str, natural_query: str, extraction: Dict = None):
         print("##########Start Schedule##########")
-        event_task = self.categorizer.categorize_event_task(natural_query)
+        extraction = extraction or {}
+        event_task = extraction.get('event_task') or self.categorizer.categorize_event_task(natural_query)
         if event_task == "Event":
-            event_json = self.query_processor.extract_event_information(natural_query, user_name)
+            event_json = extraction.get('document') or self.query_processor.extract_event_information(natural_query, user_name)
             if event_json and input('AI Assistant: Are you sure? (enter yes or no): ').strip().lower() == 'yes':
                 self.db.add_document("events", event_json)
                 self.task_scheduler.calculate_task_metrics(user_name)
                 self.task_scheduler.calculate_task_urgency(user_name)
                 self.task_scheduler.schedule_tasks(user_name)
         elif event_task == "Task":
-            task_json = self.query_processor.extract_task_information(natural_query, user_name)
+            task_json = extraction.get('document') or self.query_processor.extract_task_information(natural_query, user_name)
             if task_json and input('AI Assistant: Are you sure? (enter yes or no): ').strip().lower() == 'yes':
                 self.db.add_document("tasks", task_json)
                 self.task_scheduler.calculate_task_metrics(user_name)
@@ -1443,7 +3685,12 @@ class TaskGenieApp:
             try:
                 # Keep the original ID and update the rest
                 updated_json['_id'] = ObjectId(first_doc['_id'])
+                with_user_key(updated_json)
+                EmbeddingPipeline.mark_dirty(collection, updated_json)
                 result = self.db.db[collection].replace_one({'_id': ObjectId(first_doc['_id'])}, updated_json)
+                # The replacement carries no key_embedding until the pipeline computes a new one
+                self.db.vector_backend.discard(collection, first_doc['_id'])
+                self.embedding_pipeline.submit(collection, first_doc['_id'])
                 
                 if result.modified_count == 1:
                     print("AI Assistant: Successfully updated the document.")
@@ -1504,7 +3751,7 @@ class TaskGenieApp:
             try:
                 # Determine collection based on document structure
                 collection = 'tasks' if 'Due Date' in first_doc else 'events'
-                result = self.db.db[collection].delete_one({'_id': ObjectId(first_doc['_id'])})
+                result = self.db.delete_document(collection, first_doc['_id'])
                 
                 if result.deleted_count == 1:
                     print("AI Assistant: Successfully deleted the document.")
@@ -1559,9 +3806,47 @@ class TaskGenieApp:
                     await self.handle_delete(user_name, natural_query)
                 break
 
+def prepare_database() -> int:
+    TaskGenieApp().db.prepare()
+    print("Backfilled user keys and created missing indexes")
+    return 0
+
+def check_indexes(user_name: str) -> int:
+    db = TaskGenieApp().db
+    db.ensure_indexes()
+    report = db.explain_query_shapes(user_name)
+    for entry in report:
+        status = 'COLLSCAN' if entry['collscan'] else 'ok'
+        print(f"[{status:>8}] {entry['collection']:<20} {entry['name']:<28} {' -> '.join(entry['stages'])}")
+    collscans = sum(entry['collscan'] for entry in report)
+    print(f"{collscans} of {len(report)} query shapes fall back to a collection scan")
+    return 1 if collscans else 0
+
+def backfill_embeddings() -> int:
+    app = TaskGenieApp()
+    embedded = app.embedding_pipeline.backfill()
+    print(f"Computed {embedded} embeddings")
+    return 0
+
 async def main():
     app = TaskGenieApp()
     await app.run()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TaskGenie assistant")
+    parser.add_argument('--prepare-db', action='store_true',
+                        help="backfill user keys on old documents (once) and create missing indexes")
+    parser.add_argument('--check-indexes', action='store_true',
+                        help="create missing indexes and report query shapes that scan whole collections")
+    parser.add_argument('--user', default='probe', help="user name used for the index check")
+    parser.add_argument('--backfill-embeddings', action='store_true',
+                        help="embed every event and task that is missing or has a stale key_embedding")
+    args = parser.parse_args()
+
+    if args.prepare_db:
+        sys.exit(prepare_database())
+    if args.check_indexes:
+        sys.exit(check_indexes(args.user))
+    if args.backfill_embeddings:
+        sys.exit(backfill_embeddings())
     asyncio.run(main())
@@ -0,0 +1,34 @@
+from taskgenie import ContextPacker
+
+
+def make_events(count, scored=True):
+    events = [{'Title': f'Meeting {i}', 'Start Time': '2026-10-17 10:00:00', 'End Time': '2026-10-17 11:00:00'}
+              for i in range(count)]
+    if scored:
+        for i, event in enumerate(events):
+            event['search_score'] = 0.9 - i * 0.01
+    return events
+
+
+def make_task(scored=True):
+    task = {'Title': 'Report', 'Due Date': '2026-10-18 10:00:00', 'Duration': '30 minutes', 'Priority': 'High'}
+    if scored:
+        task['search_score'] = 0.5
+    return task
+
+
+def test_small_budget_keeps_both_kinds():
+    packer = ContextPacker(max_tokens=60)
+    for scored in (True, False):
+        text, stats = packer.pack(make_events(5, scored) + [make_task(scored)])
+        assert 'Meeting 0' in text
+        assert 'Report' in text
+        assert stats['included'] + stats['dropped'] == 6
+        assert stats['tokens'] <= 60
+
+
+def test_unused_columns_and_sections_are_left_out():
+    text, stats = ContextPacker().pack(make_events(2))
+    assert text.startswith('Events: Title | Start Time | End Time\n')
+    assert 'Tasks:' not in text
+    assert stats == {'included': 2, 'dropped': 0, 'tokens': stats['tokens']}
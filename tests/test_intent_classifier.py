@@ -0,0 +1,32 @@
+import pytest
+
+from taskgenie import IntentClassifier
+
+
+@pytest.fixture
+def classifier():
+    # No training sheet, so only the keyword rules answer
+    return IntentClassifier()
+
+
+@pytest.mark.parametrize('text, label', [
+    ("Cancel my 3pm meeting", 'Delete'),
+    ("please clear my calendar for tomorrow", 'Delete'),
+    ("move lunch to 2pm", 'Update'),
+    ("can you reschedule the dentist appointment to friday", 'Update'),
+    ("remind me to call mom tomorrow", 'Schedule'),
+    ("book a flight for next week", 'Schedule'),
+    ("what meetings do I have tomorrow", 'Query'),
+])
+def test_commands_match_their_rule(classifier, text, label):
+    assert classifier.classify_intent(text) == (label, IntentClassifier.RULE_CONFIDENCE)
+
+
+@pytest.mark.parametrize('text', [
+    "clear my head, any advice?",
+    "I want to change my diet",
+    "plan",
+    "delete",
+])
+def test_non_commands_are_left_to_the_llm(classifier, text):
+    assert classifier.classify_intent(text) == (None, 0.0)
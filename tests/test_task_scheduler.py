@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+from bson import ObjectId
+
+from taskgenie import TaskScheduler
+
+FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class RecordingDatabase:
+    def __init__(self):
+        self.writes = []
+
+    def bulk_write(self, collection, operations):
+        self.writes.append((collection, operations))
+
+
+def make_task(title, start, minutes, due):
+    return {'_id': str(ObjectId()), 'Title': title, 'Priority': 'High', 'Duration': f'{minutes} minutes',
+            'Due Date': due.strftime(FORMAT), 'Urgency': 1.0,
+            'Start Time': start.strftime(FORMAT), 'End Time': (start + timedelta(minutes=minutes)).strftime(FORMAT)}
+
+
+def make_scheduler(engine, events, tasks):
+    scheduler = TaskScheduler(RecordingDatabase(), openai_service=None, engine=engine)
+    events_df = pd.DataFrame(events, columns=['Start Time', 'End Time'])
+    scheduler.load_schedule_inputs = lambda user_name, now, refresh_urgency=False: (events_df, tasks)
+    return scheduler
+
+
+@pytest.fixture
+def morning():
+    return (datetime.now() + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+
+
+@pytest.mark.parametrize('engine', TaskScheduler.SCHEDULING_ENGINES)
+def test_task_under_a_new_event_is_moved(engine, morning):
+    # The event arrived without a changed document, e.g. through a calendar pull
+    event = (pd.Timestamp(morning), pd.Timestamp(morning + timedelta(hours=1)))
+    task = make_task('report', morning, 30, morning + timedelta(days=2))
+    scheduler = make_scheduler(engine, [event], [task])
+
+    moved = scheduler.reschedule_incremental('alice')
+
+    assert [t['Title'] for t in moved] == ['report']
+    start, end = pd.to_datetime(task['Start Time']), pd.to_datetime(task['End Time'])
+    assert end + timedelta(minutes=15) <= event[0] or start - timedelta(minutes=15) >= event[1]
+    assert len(scheduler.db.writes) == 1
+
+
+@pytest.mark.parametrize('engine', TaskScheduler.SCHEDULING_ENGINES)
+def test_tasks_clear_of_events_keep_their_slots(engine, morning):
+    event = (pd.Timestamp(morning + timedelta(hours=3)), pd.Timestamp(morning + timedelta(hours=4)))
+    tasks = [make_task('report', morning, 30, morning + timedelta(days=2)),
+             make_task('email', morning + timedelta(minutes=60), 30, morning + timedelta(days=2))]
+    scheduler = make_scheduler(engine, [event], tasks)
+
+    assert scheduler.reschedule_incremental('alice') == []
+    assert scheduler.db.writes == []
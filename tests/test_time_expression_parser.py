@@ -0,0 +1,54 @@
+from datetime import datetime
+
+import pytest
+
+from taskgenie import TimeExpressionParser
+
+# A Friday afternoon
+NOW = datetime(2026, 10, 16, 15, 30)
+
+
+@pytest.fixture
+def parser():
+    return TimeExpressionParser()
+
+
+def test_passed_time_of_day_window_is_left_to_the_llm(parser):
+    assert parser.parse_query("what do I have this morning", datetime(2026, 10, 16, 13, 0)) is None
+    assert parser.parse_query("what do I have this afternoon", datetime(2026, 10, 16, 18, 30)) is None
+
+
+def test_current_time_of_day_window_starts_now(parser):
+    query = parser.parse_query("what do I have this afternoon", NOW)
+    assert query == {"Start Time": {"$gte": "2026-10-16 15:30:00"},
+                     "End Time": {"$lte": "2026-10-16 18:00:00"}}
+
+
+def test_bare_weekday_naming_today_rolls_to_next_week(parser):
+    assert parser.parse_event_schedule("meeting on friday at 9am", NOW) == {
+        "Start Time": "2026-10-23 09:00:00", "End Time": "2026-10-23 10:00:00"}
+    assert parser.parse_task_schedule("submit report by friday 9am", NOW) == {
+        "Due Date": "2026-10-23 09:00:00"}
+
+
+def test_bare_weekday_naming_today_keeps_a_later_time(parser):
+    assert parser.parse_event_schedule("meeting on friday at 5pm", NOW) == {
+        "Start Time": "2026-10-16 17:00:00", "End Time": "2026-10-16 18:00:00"}
+
+
+def test_passed_time_today_is_left_to_the_llm(parser):
+    assert parser.parse_event_schedule("meeting today at 9am", NOW) is None
+    assert parser.parse_task_schedule("pay rent today at 10am", NOW) is None
+
+
+def test_passed_time_without_day_means_tomorrow(parser):
+    assert parser.parse_event_schedule("book dentist at 9am", NOW) == {
+        "Start Time": "2026-10-17 09:00:00", "End Time": "2026-10-17 09:30:00"}
+
+
+def test_inverted_clock_range_is_left_to_the_llm(parser):
+    assert parser.parse_event_schedule("meeting from 11 to 1pm tomorrow", NOW) is None
+
+
+def test_relative_task_deadline(parser):
+    assert parser.parse_task_schedule("submit report in 2 hours", NOW) == {"Due Date": "2026-10-16 17:30:00"}